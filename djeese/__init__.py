@@ -8,23 +8,27 @@ import sys
 
 __version__ = '0.3.1'
 
+# command names and the modules defining them, which are only imported when
+# the command is run (or its help shown), so the CLI starts fast
+COMMANDS = {
+    'checkapp': 'djeese.commands.checkapp',
+    'clonestatic': 'djeese.commands.clonestatic',
+    'createapp': 'djeese.commands.createapp',
+    'pushstatic': 'djeese.commands.pushstatic',
+    'runstatic': 'djeese.commands.runstatic',
+    'uploadapp': 'djeese.commands.uploadapp',
+}
+
 
 def get_commands():
     """
     Returns a list of all the command names that are available.
-
-    Returns an empty list if no commands are defined.
     """
-    command_dir = os.path.join(os.path.dirname(__file__), 'commands')
-    try:
-        return [f[:-3] for f in os.listdir(command_dir)
-                if not f.startswith('_') and f.endswith('.py')]
-    except OSError:
-        return []
+    return sorted(COMMANDS.keys())
 
 
 def load_command_class(name):
-    full_name = 'djeese.commands.%s' % name
+    full_name = COMMANDS[name]
     __import__(full_name)
     return sys.modules[full_name].Command()
 
@@ -3,7 +3,6 @@ from __future__ import with_statement
 from ConfigParser import SafeConfigParser
 from StringIO import StringIO
 from djeese.printer import Printer
-from djeese.utils import check_urls
 import os
 
 
@@ -80,6 +79,8 @@ def validate_templates_section(config, printer):
         else:
             paths.append(path)
     if urls:
+        # imported here, it pulls in requests
+        from djeese.urlcheck import check_urls
         responses = check_urls(urls)
         for url, success in responses:
             name = reverse_templates[url]
@@ -1,10 +1,13 @@
+from __future__ import with_statement
 from djeese.input_helpers import ask, ask_password, ask_boolean
 from djeese.printer import Printer
+from djeese.sessions import discard_session, load_session, save_session
 from optparse import make_option, OptionParser
 import djeese
 import os
 import re
 import sys
+import threading
 import urlparse
 
 AUTH_FILE = os.path.join(os.path.expanduser('~'), '.djeese')
@@ -61,6 +64,87 @@ class BaseCommand(object):
                 finally:
                     fobj.close()
         return username, password
+
+    def get_session(self, noinput=False, session=None):
+        """
+        Return `session` (or a new requests session) logged in to djeese, or
+        None if logging in failed.
+
+        The session cookies are stored and reused by later commands until they
+        expire, so most commands don't have to log in (or ask for the login
+        data) at all. If the server rejects reused cookies with a 403
+        response, the session logs in again and repeats the request. Requests
+        with streamed bodies can't be repeated automatically, their callers
+        should call relogin and repeat them themselves.
+        """
+        if session is None:
+            # imported here, commands not talking to djeese don't need it
+            import requests
+            session = requests.session()
+        self.noinput = noinput
+        self.login_lock = threading.RLock()
+        session.hooks['response'].append(self.get_relogin_hook(session))
+        cookies = load_session(self.get_absolute_url('/'))
+        if cookies is not None:
+            for cookie in cookies:
+                session.cookies.set(cookie.pop('name'), cookie.pop('value'), **cookie)
+            self.session_reused = True
+            return session
+        self.session_reused = False
+        if not self.login(session):
+            return None
+        return session
+
+    def login(self, session):
+        """
+        Log `session` in and store its cookies. Returns True if successful.
+        """
+        username, password = self.get_auth(self.noinput)
+        login_url = self.get_absolute_url(LOGIN_PATH)
+        response = session.post(login_url, {'username': username, 'password': password})
+        if response.status_code != 204:
+            discard_session(self.get_absolute_url('/'))
+            return False
+        save_session(self.get_absolute_url('/'), session.cookies)
+        return True
+
+    def relogin(self, session, request):
+        """
+        Make a reused `session` usable again after the prepared `request` was
+        rejected with a 403 response. Returns True if the request should be
+        repeated.
+        """
+        from requests.cookies import get_cookie_header
+        current = request.copy()
+        current.headers.pop('Cookie', None)
+        with self.login_lock:
+            if request.headers.get('Cookie') != get_cookie_header(session.cookies, current):
+                # another thread logged in again in the meantime
+                return True
+            if not self.session_reused:
+                # fresh sessions are rejected for a reason
+                return False
+            self.session_reused = False
+            return self.login(session)
+
+    def get_relogin_hook(self, session):
+        """
+        Return a response hook for `session` repeating requests rejected
+        because of an expired session, see get_session.
+        """
+        def relogin_hook(response, **kwargs):
+            request = response.request
+            if response.status_code != 403 or request.url == self.get_absolute_url(LOGIN_PATH):
+                return response
+            if not (request.body is None or isinstance(request.body, basestring)):
+                return response
+            if not self.relogin(session, request):
+                return response
+            request = request.copy()
+            request.headers.pop('Cookie', None)
+            request.prepare_cookies(session.cookies)
+            return session.send(request, **kwargs)
+        return relogin_hook
     
     def usage(self, subcommand):
         """
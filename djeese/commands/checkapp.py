@@ -1,18 +1,142 @@
 from __future__ import with_statement
 from djeese.apps import AppConfiguration
 from djeese.commands import BaseCommand, CommandError
+from djeese.printer import BufferedPrinter
+from multiprocessing import Pool, cpu_count
+from optparse import make_option
+import glob
 import os
 import sys
+import time
+try:
+    import json
+except ImportError:
+    import simplejson as json
+
+try:
+    DEFAULT_JOBS = cpu_count()
+except NotImplementedError:
+    DEFAULT_JOBS = 1
+
+
+def check_appfile(args):
+    """
+    Validate the app file at `appfile`, collecting the output in a
+    BufferedPrinter. Runs in the worker processes, so it takes a single
+    (appfile, verbosity) tuple and returns a dictionary for the report.
+    """
+    appfile, verbosity = args
+    start = time.time()
+    printer = BufferedPrinter(verbosity)
+    appconfig = AppConfiguration(printer=printer)
+    try:
+        appconfig.read(appfile)
+        valid = appconfig.validate()
+    except Exception, e:
+        # a broken file should not abort the whole run
+        printer.error("Could not check app file: %s" % e)
+        printer.always("Configuration invalid")
+        valid = False
+    return {
+        'file': appfile,
+        'valid': valid,
+        'errors': printer.errors,
+        'warnings': printer.warnings,
+        'output': printer.lines,
+        'duration': time.time() - start,
+    }
+
+def expand_appfiles(patterns):
+    """
+    Expand the glob `patterns` into a list of app files, in order and
+    without duplicates. Patterns without wildcards must name existing files.
+    """
+    appfiles = []
+    for pattern in patterns:
+        if glob.has_magic(pattern):
+            matches = sorted(glob.glob(pattern))
+            if not matches:
+                raise CommandError("No app files match %r." % pattern)
+        elif os.path.exists(pattern):
+            matches = [pattern]
+        else:
+            raise CommandError("App file %r not found." % pattern)
+        for appfile in matches:
+            if appfile not in appfiles:
+                appfiles.append(appfile)
+    return appfiles
+
 
 class Command(BaseCommand):
-    help = 'Validate a djeese apps.'
+    help = 'Validate djeese apps.'
+    args = '<appfile> [<appfile> ...]'
+    option_list = BaseCommand.option_list + (
+        make_option('--jobs', action='store', dest='jobs', default=DEFAULT_JOBS,
+                    type='int', help='Number of app files to check in parallel. Defaults to the number of CPUs.'),
+        make_option('--report', action='store', dest='report', default=None,
+                    help='Write a JSON report of the results to this file.'),
+    )
 
-    def handle(self, appfile=None, **options):
-        if not appfile:
+    def handle(self, *patterns, **options):
+        if not patterns:
             raise CommandError("You must provide the path to your app file as first argument")
-        if not os.path.exists(appfile):
-            raise CommandError("App file %r not found." % appfile)
-        appconfig = AppConfiguration(int(options['verbosity']))
-        appconfig.read(appfile)
-        if not appconfig.validate():
+        appfiles = expand_appfiles(patterns)
+        verbosity = int(options['verbosity'])
+        jobs = max(1, min(options['jobs'], len(appfiles)))
+        tasks = [(appfile, verbosity) for appfile in appfiles]
+        results = []
+        if jobs == 1:
+            iterator = (check_appfile(task) for task in tasks)
+            pool = None
+        else:
+            pool = Pool(jobs)
+            iterator = pool.imap(check_appfile, tasks)
+        try:
+            for result in iterator:
+                results.append(result)
+                self.print_result(result, len(appfiles) > 1)
+        finally:
+            if pool is not None:
+                pool.terminate()
+                pool.join()
+        if len(results) > 1:
+            self.print_summary(results)
+        if options['report']:
+            self.write_report(results, options['report'])
+        if [result for result in results if not result['valid']]:
             sys.exit(1)
+
+    def print_result(self, result, show_name):
+        if show_name:
+            self.printer.always("== %s" % result['file'])
+        for line in result['output']:
+            # already filtered by verbosity
+            self.printer.always(line)
+
+    def print_summary(self, results):
+        width = max([len(result['file']) for result in results] + [len('File')])
+        row = '%%-%ds  %%-7s  %%6s  %%8s  %%7s' % width
+        self.printer.always('')
+        self.printer.always(row % ('File', 'Result', 'Errors', 'Warnings', 'Time'))
+        for result in results:
+            self.printer.always(row % (
+                result['file'],
+                'valid' if result['valid'] else 'INVALID',
+                len(result['errors']),
+                len(result['warnings']),
+                '%.2fs' % result['duration'],
+            ))
+        invalid = len([result for result in results if not result['valid']])
+        self.printer.always("%s app files checked, %s valid, %s invalid" % (
+            len(results), len(results) - invalid, invalid))
+
+    def write_report(self, results, path):
+        invalid = len([result for result in results if not result['valid']])
+        report = {
+            'files': [dict([(key, value) for key, value in result.items() if key != 'output'])
+                      for result in results],
+            'valid': len(results) - invalid,
+            'invalid': invalid,
+        }
+        with open(path, 'w') as fobj:
+            json.dump(report, fobj, indent=2)
@@ -1,12 +1,27 @@
 # -*- coding: utf-8 -*-
 from __future__ import with_statement
-from djeese.commands import BaseCommand, CommandError, LOGIN_PATH
+from djeese.commands import BaseCommand, CommandError
+from djeese.commands.pushstatic import MANIFEST_PATH, has_valid_file_name
+from djeese.extract import (CountingReader, DEFAULT_MAX_INFLIGHT,
+    DEFAULT_WORKERS, ParallelExtractor, safe_join)
 from djeese.input_helpers import ask_boolean
+from djeese.manifest import build_manifest, diff_manifests, normalize_manifest
 from djeese.printer import Printer
+from multiprocessing.pool import ThreadPool
 from optparse import make_option
+import hashlib
+import os
 import requests
 import tarfile
 import traceback
+try:
+    import json
+except ImportError:
+    import simplejson as json
+
+FILE_PATH = '/api/v1/io/static/file/'
+DOWNLOAD_CHUNKSIZE = 64 * 1024
+
 
 class Command(BaseCommand):
     help = 'Clone the static files from an website'
@@ -14,6 +29,18 @@ class Command(BaseCommand):
         make_option( '--noinput', action='store_true', dest='noinput', default=False,
             help='Do not ask for input. Always assume yes.'
         ),
+        make_option('--workers', action='store', dest='workers', default=DEFAULT_WORKERS,
+            type='int', help='Number of threads writing the extracted files.'
+        ),
+        make_option('--max-inflight', action='store', dest='max_inflight', default=DEFAULT_MAX_INFLIGHT,
+            type='int', help='Maximum amount of extracted data waiting to be written, in MB.'
+        ),
+        make_option('--sync', action='store_true', dest='sync', default=False,
+            help='Only download files which are missing locally or differ from the remote ones.'
+        ),
+        make_option('--delete', action='store_true', dest='delete', default=False,
+            help='Delete local files which do not exist remotely. Requires --sync.'
+        ),
     )
 
     def handle(self, website=None, outputdir='static', **options):
@@ -22,19 +49,45 @@ class Command(BaseCommand):
         printer = Printer(int(options['verbosity']), logfile='djeese.log')
         if not website:
             raise CommandError("You must provide the name of the website from which you want to clone the static files as first argument")
+        if options['delete'] and not options['sync']:
+            raise CommandError("--delete can only be used with --sync")
         url = self.get_absolute_url('/api/v1/io/static/clone/')
-        username, password = self.get_auth(options['noinput'])
-        session = requests.session()
-        login_url = self.get_absolute_url(LOGIN_PATH)
-        response = session.post(login_url, {'username': username, 'password': password})
-        if response.status_code != 204:
+        session = self.get_session(options['noinput'])
+        if session is None:
             printer.error("Login failed")
             return
         data = {'name': website}
-        response = session.get(url, params=data)
-        if response.status_code == 200:
-            self.finish_clone(response, outputdir, printer)
-        elif response.status_code == 400:
+        if options['sync']:
+            try:
+                response = session.get(self.get_absolute_url(MANIFEST_PATH), params=data)
+            except requests.RequestException, e:
+                printer.error("Could not get the remote manifest: %s" % e)
+                printer.always("Sync failed")
+                return
+            if response.status_code == 200:
+                try:
+                    remote = normalize_manifest(json.loads(response.content))
+                except (ValueError, AttributeError):
+                    printer.error("Invalid remote manifest")
+                    printer.log_only(response.content)
+                    printer.always("Sync failed, check djeese.log for more details")
+                    return
+                self.sync(session, website, remote, outputdir, printer, **options)
+                return
+        else:
+            try:
+                response = session.get(url, params=data, stream=True)
+            except requests.RequestException, e:
+                printer.error("Could not download the static files: %s" % e)
+                printer.always("Clone failed")
+                return
+            if response.status_code == 200:
+                self.finish_clone(response, outputdir, printer, options['workers'], options['max_inflight'])
+                return
+        self.handle_error(response, printer)
+
+    def handle_error(self, response, printer):
+        if response.status_code == 400:
             self.handle_bad_request(response, printer)
             printer.always("Clone failed: Bad request")
         elif response.status_code == 403:
@@ -48,13 +101,100 @@ class Command(BaseCommand):
             printer.log_only(response.content)
             printer.always("Clone failed, check djeese.log for more details")
     
-    def finish_clone(self, response, outputdir, printer):
+    def sync(self, session, website, remote, outputdir, printer, **options):
+        """
+        Download the files listed in the `remote` manifest which are missing in
+        `outputdir` or have a different hash, and optionally delete the local
+        files not listed in it.
+        """
+        if not os.path.exists(outputdir):
+            os.makedirs(outputdir)
+        local = build_manifest(outputdir, has_valid_file_name, workers=options['workers'])
+        changed, extras = diff_manifests(local, remote)
+        printer.info("%s of %s file(s) need to be downloaded" % (len(changed), len(remote)))
+        failed = []
+        if changed:
+            pool = ThreadPool(min(options['workers'], len(changed)))
+            try:
+                results = pool.map(lambda path: self.download_file(session, website, outputdir,
+                                   path, remote[path], printer), changed)
+            finally:
+                pool.close()
+                pool.join()
+            failed = [path for path, success in zip(changed, results) if not success]
+        if options['delete']:
+            for path in extras:
+                os.remove(safe_join(outputdir, path))
+                printer.info("Deleted %s" % path)
+        if failed:
+            printer.always("Sync failed for %s file(s), check djeese.log for more details" % len(failed))
+        else:
+            printer.info("Sync successful")
+
+    def download_file(self, session, website, outputdir, path, entry, printer):
+        """
+        Download a single file and verify its hash. Returns True on success.
+        """
+        try:
+            target = safe_join(outputdir, path)
+        except ValueError, e:
+            printer.error(str(e))
+            return False
+        url = self.get_absolute_url(FILE_PATH)
+        try:
+            response = session.get(url, params={'name': website, 'path': path}, stream=True)
+        except requests.RequestException, e:
+            printer.error("Could not download %r: %s" % (path, e))
+            return False
+        if response.status_code != 200:
+            printer.error("Could not download %r (%s)" % (path, response.status_code))
+            return False
+        dirname = os.path.dirname(target)
+        if not os.path.isdir(dirname):
+            try:
+                os.makedirs(dirname)
+            except OSError:
+                # created by another download in the meantime
+                if not os.path.isdir(dirname):
+                    raise
+        tmppath = '%s.djeese-tmp' % target
+        digest = hashlib.sha256()
+        try:
+            with open(tmppath, 'wb') as fobj:
+                for chunk in response.iter_content(DOWNLOAD_CHUNKSIZE):
+                    digest.update(chunk)
+                    fobj.write(chunk)
+        except requests.RequestException, e:
+            os.remove(tmppath)
+            printer.error("Could not download %r: %s" % (path, e))
+            return False
+        if digest.hexdigest() != entry['hash']:
+            os.remove(tmppath)
+            printer.error("Checksum mismatch for %r" % path)
+            return False
+        os.rename(tmppath, target)
+        if 'mtime' in entry:
+            os.utime(target, (entry['mtime'], entry['mtime']))
+        printer.info("Downloaded %s" % path)
+        return True
+
+    def finish_clone(self, response, outputdir, printer, workers=DEFAULT_WORKERS,
+                     max_inflight=DEFAULT_MAX_INFLIGHT):
+        reader = CountingReader(response.raw)
         try:
-            tarball = tarfile.open(mode='r|gz', fileobj=response.raw)
+            tarball = tarfile.open(mode='r|gz', fileobj=reader)
         except:
             printer.error("Response not a valid tar file.")
             printer.always("Clone failed")
             traceback.print_exc(printer.logfile)
             return
-        tarball.extractall(outputdir)
+        total = int(response.headers.get('content-length', 0))
+        extractor = ParallelExtractor(outputdir, printer, workers, max_inflight)
+        try:
+            extractor.extract(tarball, reader, total)
+        except (IOError, OSError, ValueError, tarfile.TarError), e:
+            printer.error("Extracting failed: %s" % e)
+            printer.always("Clone failed")
+            traceback.print_exc(file=printer.logfile)
+            return
         printer.info("Clone successful")
@@ -1,19 +1,36 @@
 # -*- coding: utf-8 -*-
 from StringIO import StringIO
 from djeese import errorcodes
-from djeese.commands import BaseCommand, CommandError, LOGIN_PATH
+from djeese.commands import BaseCommand, CommandError
+from djeese.contentcache import ContentCache
+from djeese.compression import (COMPRESSION_CHOICES, DEFAULT_COMPRESSION,
+    DEFAULT_LEVEL, get_writer, is_precompressed, report_throughput)
 from djeese.input_helpers import ask_boolean
+from djeese.manifest import (build_manifest, diff_manifests,
+    get_tree_fingerprint, load_manifest, save_manifest)
 from djeese.printer import Printer
+from djeese.scanner import DEFAULT_WORKERS, scan_tree
+from djeese.streaming import ChunkSink, MultipartStream, SizedMultipartStream
+from djeese.upload import ChunkedUploader, UploadError, UPLOAD_OPTIONS
 from optparse import make_option
+import copy
 import os
 import re
-import requests
 import tarfile
+try:
+    import json
+except ImportError:
+    import simplejson as json
 try:
     from tarfile import bltn_open
 except ImportError: # 2.5 compatiblity
     bltn_open = file 
 
+MANIFEST_PATH = '/api/v1/io/static/manifest/'
+BLOBS_MISSING_PATH = '/api/v1/io/static/blobs/missing/'
+BLOBS_PUSH_PATH = '/api/v1/io/static/blobs/push/'
+STREAM_BUFSIZE = 64 * 1024
+
 FILENAME_BASIC_RE = re.compile(r'^[a-zA-Z]+[a-zA-Z0-9._-]*\.[a-zA-Z]{2,4}$')
 ALLOWED_EXTENSIONS = [
     '.js',
@@ -26,6 +43,12 @@ ALLOWED_EXTENSIONS = [
 ]
 
 
+def has_valid_file_name(name):
+    """
+    Like is_valid_file_name, but without printing anything.
+    """
+    return bool(FILENAME_BASIC_RE.match(name)) and os.path.splitext(name)[-1] in ALLOWED_EXTENSIONS
+
 def is_valid_file_name(name, printer):
     if not FILENAME_BASIC_RE.match(name):
         printer.always("File name %r is not a valid file name, ignoring..." % name)
@@ -101,6 +124,51 @@ class TarfileBackport(tarfile.TarFile):
         else:
             self.addfile(tarinfo)
 
+    def addfile_iter(self, tarinfo, fileobj=None, bufsize=STREAM_BUFSIZE):
+        """Generator version of addfile(). Yields after the header and after
+           every `bufsize' bytes of data written, so the caller can drain the
+           underlying file object. Unlike addfile(), the TarInfo object is not
+           kept in self.members, so memory usage stays flat.
+        """
+        self._check("aw")
+        tarinfo = copy.copy(tarinfo)
+        buf = tarinfo.tobuf(self.format, self.encoding, self.errors)
+        self.fileobj.write(buf)
+        self.offset += len(buf)
+        yield
+        if fileobj is not None:
+            remaining = tarinfo.size
+            while remaining:
+                block = fileobj.read(min(bufsize, remaining))
+                if not block:
+                    raise IOError("end of file reached")
+                self.fileobj.write(block)
+                remaining -= len(block)
+                yield
+            blocks, remainder = divmod(tarinfo.size, tarfile.BLOCKSIZE)
+            if remainder > 0:
+                self.fileobj.write(tarfile.NUL * (tarfile.BLOCKSIZE - remainder))
+                blocks += 1
+            self.offset += blocks * tarfile.BLOCKSIZE
+
+    def get_stream_size(self, tarinfos):
+        """Return the exact size of an uncompressed archive containing
+           `tarinfos' once it is closed.
+        """
+        size = self.offset
+        for tarinfo in tarinfos:
+            size += len(tarinfo.tobuf(self.format, self.encoding, self.errors))
+            if tarinfo.isreg():
+                blocks, remainder = divmod(tarinfo.size, tarfile.BLOCKSIZE)
+                if remainder > 0:
+                    blocks += 1
+                size += blocks * tarfile.BLOCKSIZE
+        size += tarfile.BLOCKSIZE * 2
+        blocks, remainder = divmod(size, tarfile.RECORDSIZE)
+        if remainder > 0:
+            size += tarfile.RECORDSIZE - remainder
+        return size
+
 
 class Command(BaseCommand):
     help = 'Clone the static files from an website'
@@ -108,7 +176,29 @@ class Command(BaseCommand):
         make_option( '--noinput', action='store_true', dest='noinput', default=False,
             help='Do not ask for input. Always assume yes.'
         ),
-    )
+        make_option('--stream', action='store', dest='stream', default=None,
+            type='choice', choices=['chunked', 'length'],
+            help='Stream the upload instead of building it in memory. '
+                 '"chunked" uses chunked transfer encoding, "length" sends an '
+                 'uncompressed archive with a precomputed Content-Length.'
+        ),
+        make_option('--workers', action='store', dest='workers', default=DEFAULT_WORKERS,
+            type='int', help='Number of threads used to hash the source directory for --delta and --dedupe and for pgzip compression.'
+        ),
+        make_option('--compression', action='store', dest='compression', default=DEFAULT_COMPRESSION,
+            type='choice', choices=COMPRESSION_CHOICES,
+            help='How to compress the archive: gzip, pgzip (gzip using multiple threads) or store (no compression).'
+        ),
+        make_option('--compression-level', action='store', dest='compression_level', default=DEFAULT_LEVEL,
+            type='int', help='gzip compression level (0-9, 0 stores without compressing).'
+        ),
+        make_option('--delta', action='store_true', dest='delta', default=False,
+            help='Only push files that changed since the last push and remove deleted files.'
+        ),
+        make_option('--dedupe', action='store_true', dest='dedupe', default=False,
+            help='Only upload file contents the server does not have yet, using a local content cache.'
+        ),
+    ) + UPLOAD_OPTIONS
 
     def handle(self, website=None, sourcedir='static', **options):
         if not options['noinput'] and ask_boolean("Are you sure? This will override all files remotely!", default=True) == 'false':
@@ -118,19 +208,107 @@ class Command(BaseCommand):
             raise CommandError("You must provide the name of the website from which you want to push the static files as first argument")
         if not os.path.exists(sourcedir):
             raise CommandError("Source directory %r not found" % sourcedir)
+        if options['stream'] and options['resumable']:
+            raise CommandError("--stream and --resumable can not be combined")
+        if options['dedupe'] and (options['stream'] or options['delta']):
+            raise CommandError("--dedupe can not be combined with --stream or --delta")
+        if not 0 <= options['compression_level'] <= 9:
+            raise CommandError("--compression-level must be between 0 and 9")
         url = self.get_absolute_url('/api/v1/io/static/push/')
-        username, password = self.get_auth(options['noinput'])
-        session = requests.session()
-        login_url = self.get_absolute_url(LOGIN_PATH)
-        response = session.post(login_url, {'username': username, 'password': password})
-        if response.status_code != 204:
+        session = self.get_session(options['noinput'])
+        if session is None:
             printer.error("Login failed")
             return
+        uploader = None
+        if options['resumable']:
+            uploader = ChunkedUploader(session, self.get_absolute_url, 'static-%s' % website,
+                printer, options['part_size'], options['upload_workers'])
+            if options['restart']:
+                uploader.discard()
+            state = uploader.load_state()
+            if state and uploader.check_source(state, self.get_source(sourcedir, options['workers'])):
+                success = self.upload_resumable(printer, uploader.resume, state)
+                # delta and dedupe pushes keep their manifest in the state
+                if success and state.get('extra'):
+                    save_manifest(self.get_absolute_url('/'), website, state['extra'])
+                return
         data = {'name': website}
-        files = {'static': self.build_tarball(sourcedir, printer)}
-        response = session.post(url, data=data, files=files)
+        if options['dedupe']:
+            self.push_blobs(session, uploader, website, sourcedir, printer, **options)
+            return
+        if options['delta']:
+            manifest, changed, deleted = self.build_delta(session, website, sourcedir, printer, options['workers'])
+            if not (changed or deleted):
+                printer.always("Nothing to push")
+                return
+            printer.info("Pushing %s changed file(s), deleting %s file(s)" % (len(changed), len(deleted)))
+            data['delta'] = 'true'
+            data['deleted'] = json.dumps(deleted)
+        else:
+            changed = None
+        compression = options['compression']
+        if options['stream'] == 'length':
+            compression = 'store'
+        tarball_options = {
+            'paths': changed,
+            'workers': options['workers'],
+            'compression': compression,
+            'level': options['compression_level'],
+        }
+        if uploader is not None:
+            tarball = self.build_tarball(sourcedir, printer, **tarball_options)
+            success = self.upload_resumable(printer, uploader.upload, tarball, dict(data, kind='static'),
+                manifest if options['delta'] else None, self.get_source(sourcedir, options['workers']))
+        else:
+            if options['stream']:
+                response = self.post_stream(session, url, data, sourcedir, printer, tarball_options)
+                if response.status_code == 403 and self.relogin(session, response.request):
+                    # the stored session expired, the stream has to be built again
+                    response = self.post_stream(session, url, data, sourcedir, printer, tarball_options)
+            else:
+                files = {'static': self.build_tarball(sourcedir, printer, **tarball_options)}
+                response = session.post(url, data=data, files=files)
+            success = self.handle_response(response, printer)
+        if success and options['delta']:
+            save_manifest(self.get_absolute_url('/'), website, manifest)
+
+    def post_stream(self, session, url, data, sourcedir, printer, tarball_options):
+        chunks, length = self.stream_tarball(sourcedir, printer, **tarball_options)
+        if length is None:
+            body = MultipartStream(data, 'static', 'static.tar.gz', chunks)
+        else:
+            body = SizedMultipartStream(data, 'static', 'static.tar', chunks, length)
+        return session.post(url, data=body, headers={'Content-Type': body.content_type})
+
+    def get_source(self, sourcedir, workers=DEFAULT_WORKERS):
+        """
+        Fingerprint of `sourcedir` for resumable uploads, so an interrupted
+        push is not resumed after files changed.
+        """
+        return get_tree_fingerprint(sourcedir, has_valid_file_name, workers)
+
+    def upload_resumable(self, printer, method, *args):
+        """
+        Run `method` of a ChunkedUploader with `args` and handle the response.
+        Returns True if the push was successful.
+        """
+        try:
+            response = method(*args)
+        except UploadError, e:
+            printer.error(str(e))
+            if e.response is not None:
+                printer.log_only(e.response.content)
+            printer.always("Push interrupted, run the same command again to resume it")
+            return False
+        return self.handle_response(response, printer)
+
+    def handle_response(self, response, printer):
+        """
+        Print the outcome of a push. Returns True if it was successful.
+        """
         if response.status_code == 204:
             printer.always("Sucess")
+            return True
         elif response.status_code == 400:
             self.handle_bad_request(response, printer)
             printer.always("Push failed: Bad request")
@@ -144,6 +322,7 @@ class Command(BaseCommand):
             printer.error("Unexpected response: %s" % response.status_code)
             printer.log_only(response.content)
             printer.always("Push failed, check djeese.log for more details")
+        return False
     
     def handle_bad_request(self, response, printer):
         code = int(response.headers.get('X-DJEESE-ERROR-CODE', 0))
@@ -167,17 +346,190 @@ class Command(BaseCommand):
             printer.error("Unexpected error code: %s (%s)" % (code, meta))
         printer.info(response.content)
     
-    def build_tarball(self, sourcedir, printer):
-        buffer = StringIO()
-        tarball = TarfileBackport.open(fileobj=buffer, mode='w:gz')
-        def static_files_filter(tarinfo):
-            if not tarinfo.isfile():
-                return tarinfo
-            if is_valid_file_name(os.path.basename(tarinfo.name), printer):
-                return tarinfo
+    def fetch_remote_manifest(self, session, website, printer):
+        """
+        Ask the server for the manifest (path to hash mapping) of the static
+        files of `website`. Returns None if the server can't provide one.
+        """
+        url = self.get_absolute_url(MANIFEST_PATH)
+        response = session.get(url, params={'name': website})
+        if response.status_code != 200:
+            printer.info("No remote manifest available (%s), using local manifest" % response.status_code)
             return None
-        tarball.add(sourcedir, filter=static_files_filter)
+        try:
+            manifest = json.loads(response.content)
+        except ValueError:
+            manifest = None
+        if not isinstance(manifest, dict):
+            printer.warning("Invalid remote manifest, using local manifest")
+            return None
+        return manifest
+
+    def build_delta(self, session, website, sourcedir, printer, workers=DEFAULT_WORKERS):
+        """
+        Build the manifest of `sourcedir` and compare it with the remote
+        manifest or, if not available, the one of the last successful push.
+
+        Returns a tuple of (manifest, changed, deleted).
+        """
+        previous = load_manifest(self.get_absolute_url('/'), website)
+        manifest = build_manifest(sourcedir, lambda name: is_valid_file_name(name, printer),
+            previous, workers)
+        remote = self.fetch_remote_manifest(session, website, printer)
+        if remote is None:
+            remote = previous
+        changed, deleted = diff_manifests(remote, manifest)
+        return manifest, changed, deleted
+
+    def build_blob_tarball(self, session, website, sourcedir, printer,
+                           workers=DEFAULT_WORKERS, level=DEFAULT_LEVEL):
+        """
+        Build an uncompressed tarball containing 'manifest.json' (mapping
+        paths to hashes) and, in 'blobs/', the (gzipped) contents of the files
+        the server does not have yet.
+
+        Returns a tuple of (manifest, tarball).
+        """
+        previous = load_manifest(self.get_absolute_url('/'), website)
+        manifest = build_manifest(sourcedir, lambda name: is_valid_file_name(name, printer),
+            previous, workers)
+        paths = {}
+        for path, entry in sorted(manifest.items()):
+            paths.setdefault(entry['hash'], path)
+        hashes = sorted(paths)
+        response = session.post(self.get_absolute_url(BLOBS_MISSING_PATH),
+            data={'name': website, 'hashes': json.dumps(hashes)})
+        missing = hashes
+        if response.status_code == 200:
+            try:
+                remote = json.loads(response.content)
+            except ValueError:
+                remote = None
+            if isinstance(remote, list):
+                missing = [hexdigest for hexdigest in remote
+                           if isinstance(hexdigest, basestring) and hexdigest in paths]
+            else:
+                printer.warning("Invalid list of missing files from server, uploading all")
+        else:
+            printer.warning("Could not get missing files from server (%s), uploading all" % response.status_code)
+        printer.info("Uploading %s of %s unique file(s)" % (len(missing), len(hashes)))
+        cache = ContentCache()
+        buffer = StringIO()
+        tarball = TarfileBackport.open(fileobj=buffer, mode='w')
+        for hexdigest in sorted(missing):
+            filepath = os.path.join(sourcedir, *paths[hexdigest].split('/'))
+            blobpath, name = cache.get_blob(hexdigest, filepath, level)
+            tarball.add(blobpath, arcname='blobs/%s' % name)
+        content = json.dumps(dict([(path, entry['hash']) for path, entry in manifest.items()]))
+        tarinfo = tarfile.TarInfo('manifest.json')
+        tarinfo.size = len(content)
+        tarball.addfile(tarinfo, StringIO(content))
+        tarball.close()
+        cache.prune()
+        buffer.seek(0)
+        return manifest, buffer
+
+    def push_blobs(self, session, uploader, website, sourcedir, printer, **options):
+        """
+        Push `sourcedir` to `website`, only uploading file contents which the
+        server does not have yet.
+        """
+        manifest, tarball = self.build_blob_tarball(session, website, sourcedir, printer,
+            options['workers'], options['compression_level'])
+        data = {'name': website}
+        if uploader is not None:
+            success = self.upload_resumable(printer, uploader.upload, tarball, dict(data, kind='static-blobs'),
+                manifest, self.get_source(sourcedir, options['workers']))
+        else:
+            response = session.post(self.get_absolute_url(BLOBS_PUSH_PATH), data=data, files={'static': tarball})
+            success = self.handle_response(response, printer)
+        if success:
+            save_manifest(self.get_absolute_url('/'), website, manifest)
+
+    def iter_static_files(self, tarball, sourcedir, printer, paths=None):
+        """
+        Yield a tuple of (name, tarinfo) for every entry of `sourcedir` with a
+        valid file name, in the order they should be added to `tarball`.
+
+        The tree is scanned in the calling thread, a single lstat per entry
+        does not pay for a thread pool. If `paths` (relative to `sourcedir`)
+        is given, only those files are yielded.
+        """
+        if paths is not None:
+            for path in paths:
+                name = os.path.join(sourcedir, *path.split('/'))
+                yield name, tarball.gettarinfo(name)
+            return
+        def process(entry):
+            return entry.path, tarball.gettarinfo(entry.path)
+        file_filter = lambda name: is_valid_file_name(name, printer)
+        for name, tarinfo in scan_tree(sourcedir, file_filter, process, workers=1):
+            if tarinfo is not None:
+                yield name, tarinfo
+
+    def iter_write(self, tarball, writer, entries):
+        """
+        Add `entries` (as yielded by iter_static_files) to `tarball`, which
+        writes to `writer`. Yields whenever data was written, so the caller can
+        drain the underlying file object. Already compressed files are stored
+        instead of being compressed again.
+        """
+        for name, tarinfo in entries:
+            if not tarinfo.isreg():
+                for _ in tarball.addfile_iter(tarinfo):
+                    yield
+                continue
+            if is_precompressed(name):
+                writer.set_level(0)
+            fobj = bltn_open(name, 'rb')
+            try:
+                for _ in tarball.addfile_iter(tarinfo, fobj):
+                    yield
+            finally:
+                fobj.close()
+                writer.set_level()
+
+    def stream_tarball(self, sourcedir, printer, paths=None, workers=DEFAULT_WORKERS,
+                       compression=DEFAULT_COMPRESSION, level=DEFAULT_LEVEL):
+        """
+        Like build_tarball, but returns a tuple of (chunks, length), where
+        chunks is a generator producing the archive while walking `sourcedir`.
+
+        If `compression` is 'store', length is the exact size of the archive,
+        otherwise it is None.
+        """
+        sink = ChunkSink()
+        writer = get_writer(sink, compression, level, workers)
+        tarball = TarfileBackport.open(fileobj=writer, mode='w')
+        entries = self.iter_static_files(tarball, sourcedir, printer, paths)
+        length = None
+        if compression == 'store':
+            entries = list(entries)
+            length = tarball.get_stream_size([tarinfo for name, tarinfo in entries])
+        def generate():
+            for _ in self.iter_write(tarball, writer, entries):
+                yield sink.drain()
+            tarball.close()
+            writer.close()
+            report_throughput(writer, printer)
+            yield sink.drain()
+        return generate(), length
+
+    def build_tarball(self, sourcedir, printer, paths=None, workers=DEFAULT_WORKERS,
+                      compression=DEFAULT_COMPRESSION, level=DEFAULT_LEVEL):
+        """
+        Build a tarball of `sourcedir`, compressed according to `compression`.
+        If `paths` (relative to `sourcedir`) is given, only those files are
+        added.
+        """
+        buffer = StringIO()
+        writer = get_writer(buffer, compression, level, workers)
+        tarball = TarfileBackport.open(fileobj=writer, mode='w')
+        entries = self.iter_static_files(tarball, sourcedir, printer, paths)
+        for _ in self.iter_write(tarball, writer, entries):
+            pass
         tarball.close()
+        writer.close()
+        report_throughput(writer, printer)
         buffer.seek(0)
         return buffer
-    
\ No newline at end of file
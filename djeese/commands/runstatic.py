@@ -3,13 +3,90 @@ from BaseHTTPServer import HTTPServer
 from SimpleHTTPServer import SimpleHTTPRequestHandler
 from SocketServer import ForkingMixIn
 from djeese.commands import BaseCommand, CommandError
+from djeese.fileserver import (GzipCache, GZIP_MIN_SIZE, PRECOMPRESSED_SIBLINGS,
+    accepts_encoding, get_etag, is_compressible, parse_range, send_range)
+from djeese.httpcache import (CacheEntry, ResponseCache, DEFAULT_CACHE_SIZE,
+    get_lifetime, is_storable, parse_cache_control, parse_http_date)
+from djeese.livereload import (LiveReload, DEBOUNCE, INJECTABLE_ENCODINGS,
+    LIVERELOAD_PATH, LIVERELOAD_SCRIPT, LIVERELOAD_SCRIPT_PATH, PING_INTERVAL,
+    decode_body, get_event, inject_script)
 from djeese.printer import Printer
+from djeese.streaming import ChunkedRequestBody, RequestBody
+from djeese.staticindex import StaticIndex, POLL_INTERVAL, is_safe_path
+from djeese.upstream import (UpstreamStats, DEFAULT_CONNECT_TIMEOUT, DEFAULT_POOL_CONNECTIONS,
+    DEFAULT_READ_TIMEOUT, DEFAULT_RETRIES, DEFAULT_RETRY_BACKOFF, get_connection_stats,
+    make_session)
 from optparse import make_option
 from requests.structures import CaseInsensitiveDict
+import Queue
 import cgi
 import os
 import requests
+import socket
+import threading
+import time
+import urllib
 import urlparse
+try:
+    import json
+except ImportError:
+    import simplejson as json
+
+DEFAULT_ENGINE = 'thread'
+DEFAULT_THREADS = 16
+STATS_PATH = '/__djeese__/stats'
+STREAM_CHUNKSIZE = 16 * 1024
+# seconds an idle keep-alive connection may hold on to a handler
+KEEPALIVE_TIMEOUT = 15
+# headers which only apply to a single connection and are never proxied
+HOP_BY_HOP_HEADERS = ['connection', 'keep-alive', 'proxy-authenticate',
+                      'proxy-authorization', 'te', 'trailers', 'transfer-encoding',
+                      'upgrade']
+# headers describing the request body, set by requests for the body it sends
+BODY_HEADERS = ['content-length', 'expect']
+# conditional request headers the cache answers itself
+CONDITIONAL_HEADERS = ['if-none-match', 'if-modified-since']
+# headers sent with a 304 response to a conditional request
+NOT_MODIFIED_HEADERS = ['cache-control', 'date', 'etag', 'expires', 'last-modified', 'vary']
+
+
+def get_header_items(response):
+    """
+    Return the headers of `response` as a list of (name, value) tuples,
+    keeping repeated headers (eg Set-Cookie) apart if possible.
+    """
+    headers = response.raw.headers
+    if hasattr(headers, 'getlist'):
+        return [(key, value) for key in headers for value in headers.getlist(key)]
+    return response.headers.items()
+
+def rewrite_location(value, netloc):
+    """
+    Make a Location header pointing to the remote site at `netloc` relative,
+    so the browser stays on this server.
+    """
+    scheme, locnetloc, path, query, fragment = urlparse.urlsplit(value)
+    if locnetloc != netloc:
+        return value
+    return urlparse.urlunsplit(('', '', path or '/', query, fragment))
+
+def rewrite_set_cookie(value):
+    """
+    Make a Set-Cookie header of the remote site apply to this server, by
+    removing its Domain and Secure attributes.
+    """
+    attributes = value.split(';')
+    cookie = [attributes[0]]
+    for attribute in attributes[1:]:
+        name, _, argument = attribute.strip().partition('=')
+        name = name.lower()
+        if name in ('domain', 'secure'):
+            continue
+        if name == 'samesite' and argument.strip().lower() == 'none':
+            # browsers only accept SameSite=None for secure cookies
+            attribute = ' SameSite=Lax'
+        cookie.append(attribute)
+    return ';'.join(cookie)
 
 
 class StaticHandler(SimpleHTTPRequestHandler):
@@ -17,84 +94,201 @@ class StaticHandler(SimpleHTTPRequestHandler):
     Proxies everything to StaticServer.proxied_to except for paths starting
     with '/static/' if those files exist in StaticServer.staticfolder, in which
     case it serves the local file.
+
+    Speaks HTTP/1.1 so browsers can keep their connections open and proxied
+    responses of unknown length can be sent chunked.
     """
+    protocol_version = 'HTTP/1.1'
+    timeout = KEEPALIVE_TIMEOUT
+    # headers and body are written separately, don't let the body wait for
+    # the browser to acknowledge the headers
+    disable_nagle_algorithm = True
+
     def do_GET(self):
         # check if it's a /static/ request
         _, _, path, _, query, _ = urlparse.urlparse(self.path)
         params = cgi.parse_qs(query)
-        if path == '/login/':
-            return self.send_message("We are sorry, but login is not supported yet")
+        if path == STATS_PATH:
+            return self.send_message(json.dumps(self.get_stats(), indent=2), 'application/json')
+        if self.server.livereload is not None:
+            if path == LIVERELOAD_PATH:
+                return self.serve_livereload()
+            if path == LIVERELOAD_SCRIPT_PATH:
+                return self.send_message(LIVERELOAD_SCRIPT, 'application/javascript')
         if path.startswith('/static/'):
-            shortpath = path[8:]
-            # translate the filepath
-            filepath = os.path.join(self.server.staticfolder, shortpath)
+            shortpath = urllib.unquote(path[8:])
+            if not is_safe_path(shortpath):
+                return self.send_error(403, "Path outside of the static folder")
             # check if it's there
-            if os.path.exists(filepath):
-                return self.serve_file(filepath)
+            entry = self.server.index.lookup(shortpath)
+            if entry is not None:
+                return self.serve_file(entry)
         return self.proxy(path, params=params)
     
-    def send_message(self, message):
+    def get_stats(self):
+        """
+        Return the statistics served at STATS_PATH.
+        """
+        stats = {
+            'uptime': int(time.time() - self.server.started),
+            'upstream': self.server.stats.to_json(),
+            'connections': get_connection_stats(self.server.session),
+        }
+        if self.server.cache is not None:
+            cache = self.server.cache
+            stats['cache'] = {
+                'hits': cache.hits,
+                'revalidated': cache.revalidated,
+                'misses': cache.misses,
+                'size': cache.size,
+            }
+        return stats
+
+    def send_message(self, message, ctype='text/plain'):
         self.send_response(200)
-        self.send_header("Content-type", 'text/plain')
+        self.send_header("Content-type", ctype)
         self.send_header('Content-Length', len(message))
         self.end_headers()
         self.wfile.write(message)
     
-    def serve_file(self, filepath):
+    def serve_file(self, entry):
         """
-        Serve the file at `filepath`. Code mostly taken from SimpleHTTPServer.
+        Serve the file of the StaticIndex `entry`. Code originally taken from
+        SimpleHTTPServer.
+
+        Supports conditional requests (ETag and Last-Modified), which are
+        answered from the index, and single byte ranges. If the browser
+        accepts it, a precompressed '.br' or '.gz' sibling of the file is
+        served instead, or text files are gzipped (and kept in the server's
+        gzip cache).
         """
-        ctype = self.guess_type(filepath)
+        if entry.ctype is None:
+            entry.ctype = self.guess_type(entry.path)
+        ctype = entry.ctype
+        acceptencoding = self.headers.get('accept-encoding')
+        served, encoding = entry, None
+        for siblingencoding, extension in PRECOMPRESSED_SIBLINGS:
+            sibling = self.server.index.lookup(entry.relpath + extension)
+            if sibling is not None and accepts_encoding(acceptencoding, siblingencoding):
+                served, encoding = sibling, siblingencoding
+                break
+        rangeheader = self.headers.get('range')
+        gzipped = (encoding is None and rangeheader is None and served.st_size >= GZIP_MIN_SIZE and
+                   is_compressible(ctype) and accepts_encoding(acceptencoding, 'gzip'))
+        if gzipped:
+            encoding = 'gzip'
+        if self.is_not_modified(get_etag(served, encoding), served.st_mtime):
+            self.send_response(304)
+            self.send_header("ETag", get_etag(served, encoding))
+            self.send_header("Last-Modified", self.date_time_string(served.st_mtime))
+            self.end_headers()
+            return
         try:
-            fobj = open(filepath, 'rb')
+            fobj = open(served.path, 'rb')
         except IOError:
             self.send_error(404, "File not found")
             return None
-        self.send_response(200)
-        self.send_header("Content-type", ctype)
-        fs = os.fstat(fobj.fileno())
-        self.send_header("Content-Length", str(fs[6]))
-        self.send_header("Last-Modified", self.date_time_string(fs.st_mtime))
-        self.end_headers()
-        self.copyfile(fobj, self.wfile)
+        try:
+            fs = os.fstat(fobj.fileno())
+            etag = get_etag(fs, encoding)
+            lastmodified = self.date_time_string(fs.st_mtime)
+            if gzipped:
+                content = self.server.gzip_cache.get(served.path, fs)
+                start, length = 0, len(content)
+            else:
+                start, length = 0, fs.st_size
+            status = 200
+            contentrange = None
+            ifrange = self.headers.get('if-range')
+            if rangeheader is not None and ifrange in (None, etag, lastmodified):
+                try:
+                    byterange = parse_range(rangeheader, fs.st_size)
+                except ValueError:
+                    self.send_response(416)
+                    self.send_header("Content-Range", "bytes */%s" % fs.st_size)
+                    self.send_header("Content-Length", "0")
+                    self.end_headers()
+                    return
+                if byterange is not None:
+                    status = 206
+                    start, length = byterange[0], byterange[1] - byterange[0] + 1
+                    contentrange = "bytes %s-%s/%s" % (byterange[0], byterange[1], fs.st_size)
+            self.send_response(status)
+            self.send_header("Content-type", ctype)
+            self.send_header("Content-Length", str(length))
+            if contentrange is not None:
+                self.send_header("Content-Range", contentrange)
+            if encoding is not None:
+                self.send_header("Content-Encoding", encoding)
+            self.send_header("Vary", "Accept-Encoding")
+            self.send_header("Accept-Ranges", "bytes")
+            self.send_header("ETag", etag)
+            self.send_header("Last-Modified", lastmodified)
+            self.end_headers()
+            if gzipped:
+                self.wfile.write(content)
+            else:
+                send_range(self.connection, self.wfile, fobj, start, length)
+        finally:
+            fobj.close()
+
+    def is_not_modified(self, etag, mtime):
+        """
+        Check the conditional headers of the request against the `etag` and
+        `mtime` of the file.
+        """
+        ifnonematch = self.headers.get('if-none-match')
+        if ifnonematch is not None:
+            return ifnonematch.strip() == '*' or etag in [tag.strip() for tag in ifnonematch.split(',')]
+        since = parse_http_date(self.headers.get('if-modified-since'))
+        return since is not None and int(mtime) <= since
     
     def do_POST(self):
         """
-        Post ALWAYS gets proxied
+        POST, PUT, PATCH and DELETE requests always get proxied, their body is
+        streamed to the remote site as it arrives.
         """
-        message = "We are sorry, but POST requests are currently not allowed"
-        return self.send_message(message)
-        
-        
-        # Parse the form data posted
-        form = cgi.FieldStorage(
-            fp=self.rfile, 
-            headers=self.headers,
-            environ={'REQUEST_METHOD':'POST',
-                     'CONTENT_TYPE':self.headers['Content-Type'],
-                     })
-        
-        data = {}
-        files = {}
-
-        # Echo back information about what was posted in the form
-        for field in form.keys():
-            field_item = form[field]
-            if field_item.filename:
-                # The field contains an uploaded file
-                files[field] = field_item.file
-            else:
-                # Regular form value
-                data[field] = field_item.value
+        _, _, path, _, query, _ = urlparse.urlparse(self.path)
+        params = cgi.parse_qs(query)
+        try:
+            body = self.get_request_body()
+        except ValueError:
+            self.close_connection = 1
+            return self.send_error(400, "Invalid Content-Length")
+        try:
+            self.proxy(path, self.command.lower(), params=params, data=body)
+        finally:
+            # the rest of an unread body would be taken for the next request
+            if body is not None and not body.exhausted:
+                self.close_connection = 1
+
+    do_PUT = do_PATCH = do_DELETE = do_POST
 
-        return self.proxy('post', data, files)
+    def get_request_body(self):
+        """
+        Return the body of the request as a RequestBody or ChunkedRequestBody
+        reading from the connection, or None if there is none.
+        """
+        if self.headers.get('expect', '').lower() == '100-continue':
+            self.wfile.write('%s 100 Continue\r\n\r\n' % self.protocol_version)
+        if 'chunked' in self.headers.get('transfer-encoding', '').lower():
+            return ChunkedRequestBody(self.rfile)
+        length = int(self.headers.get('content-length') or 0)
+        if length < 0:
+            raise ValueError("Negative Content-Length")
+        if not length:
+            return None
+        return RequestBody(self.rfile, length)
     
     def proxy(self, path, method='get', params=None, data=None, files=None):
         """
         Proxy to the remote site using requests (which is awesome)
         
-        This is a tad inefficient and slow, but should work for reasonably
-        sized requests.
+        The response body is relayed as it arrives, without decoding it, so
+        the content-encoding and content-length of the remote site stay valid.
+        If the remote site does not send a content-length, the body is sent
+        chunked to HTTP/1.1 clients and delimited by closing the connection
+        for HTTP/1.0 clients.
         """
         # get scheme and netlocation from remote server
         scheme, netloc, _, _, _ = urlparse.urlsplit(self.server.proxied_to)
@@ -102,54 +296,385 @@ class StaticHandler(SimpleHTTPRequestHandler):
         # add the path
         url = urlparse.urlunsplit((scheme, netloc, path, '', ''))
         requestheaders = CaseInsensitiveDict(self.headers)
+        for header in HOP_BY_HOP_HEADERS:
+            if header in requestheaders:
+                del requestheaders[header]
+        # requests sets these for the body it sends
+        for header in BODY_HEADERS:
+            if header in requestheaders:
+                del requestheaders[header]
         requestheaders['referer'] = self.server.last
         requestheaders['host'] = netloc
         self.server.last = url
-        # get the response
-        method = getattr(self.server.session, method)
-        extra = {}
-        if method == 'get':
-            extra['allow_redirects'] = True
-        response = method(url, params=params, data=data, files=files, headers=requestheaders, **extra)
-        content = response.raw.read()
-        length = len(content)
+        cache = self.server.cache
+        with self.server.stats.track():
+            if cache is not None and method == 'get' and self.is_cacheable(requestheaders):
+                return self.cached_proxy(cache, url, params, requestheaders)
+            # redirects are passed on to the browser (with a rewritten
+            # Location), requests would follow them without the cookies
+            response = self.request_upstream(method, url, params=params, data=data, files=files,
+                                             headers=requestheaders, allow_redirects=False)
+            if response is None:
+                return
+            try:
+                self.relay(response, has_body=method != 'head')
+            finally:
+                response.close()
+
+    def request_upstream(self, method, url, **kwargs):
+        """
+        Make a streaming request to the remote site, recording its latency.
+        Returns the response, or None if the request failed or the request body
+        could not be read, in which case an error was sent to the browser.
+        """
+        send = getattr(self.server.session, method)
+        started = time.time()
+        try:
+            response = send(url, stream=True, timeout=self.server.upstream_timeout, **kwargs)
+        except requests.RequestException, e:
+            self.server.stats.record(None)
+            self.server.printer.error("Request to %s failed: %s" % (url, e))
+            self.send_error(502, "Request to the remote site failed")
+            return None
+        except IOError, e:
+            # the body could not be read from the browser, the rest of the
+            # connection can't be trusted either
+            self.close_connection = 1
+            self.server.printer.error("Reading the request body failed: %s" % e)
+            self.send_error(400, "Invalid request body")
+            return None
+        self.server.stats.record(time.time() - started)
+        return response
+
+    def is_cacheable(self, requestheaders):
+        """
+        Check whether the response to a GET request with `requestheaders` may
+        be taken from and stored in the cache.
+        """
+        return 'authorization' not in requestheaders and 'range' not in requestheaders
+
+    def cached_proxy(self, cache, url, params, requestheaders):
+        """
+        Proxy a GET request through the response cache. Fresh responses are
+        served from the cache, stale ones are revalidated with a conditional
+        request to the remote site.
+        """
+        cacheurl = url
+        if params:
+            cacheurl = '%s?%s' % (url, urllib.urlencode(sorted(params.items()), True))
+        key = cache.get_key(cacheurl, requestheaders)
+        now = time.time()
+        entry = cache.get(key)
+        # reloads ask to revalidate
+        directives = parse_cache_control(requestheaders.get('cache-control'))
+        revalidate = 'no-cache' in directives or directives.get('max-age') == '0'
+        if entry is None:
+            conditionals = {}
+        else:
+            # conditional requests of the browser are answered from the cache
+            conditionals = dict([(header, requestheaders.pop(header))
+                                 for header in CONDITIONAL_HEADERS if header in requestheaders])
+            if not revalidate and entry.is_fresh(now):
+                return self.send_cached(cache, 'hits', cacheurl, entry, conditionals)
+            requestheaders.update(entry.get_validators())
+        response = self.request_upstream('get', url, params=params, headers=requestheaders,
+                                         allow_redirects=False)
+        if response is None:
+            return
+        try:
+            if entry is not None and response.status_code == 304:
+                entry.refresh(response.headers, now)
+                cache.set(key, entry)
+                return self.send_cached(cache, 'revalidated', cacheurl, entry, conditionals)
+            cache.count('misses')
+            limit = None
+            if is_storable(response.status_code, response.headers):
+                limit = cache.max_size
+            body = self.relay(response, limit=limit)
+        finally:
+            response.close()
+        if body is not None:
+            headers = [(name, value) for name, value in response.headers.items()
+                       if name.lower() not in HOP_BY_HOP_HEADERS]
+            lifetime = get_lifetime(response.headers, now)
+            cache.set(key, CacheEntry(response.status_code, headers, body, now, lifetime))
+        self.server.printer.info("Cache miss: %s (%s)" % (cacheurl, cache.get_stats()))
+
+    def send_cached(self, cache, outcome, cacheurl, entry, conditionals):
+        """
+        Send the cached `entry`, or a 304 response if it matches the
+        `conditionals` of the browser.
+        """
+        cache.count(outcome)
+        etag = entry.headers.get('etag')
+        if 'if-none-match' in conditionals:
+            not_modified = etag is not None and (conditionals['if-none-match'].strip() == '*' or
+                etag in [tag.strip() for tag in conditionals['if-none-match'].split(',')])
+        else:
+            not_modified = (conditionals.get('if-modified-since') is not None and
+                conditionals['if-modified-since'] == entry.headers.get('last-modified'))
+        if not_modified:
+            self.send_response(304)
+            for key, value in entry.headers.items():
+                if key.lower() in NOT_MODIFIED_HEADERS:
+                    self.send_header(key, value)
+            self.end_headers()
+        elif self.wants_script(entry.status, entry.headers):
+            self.send_with_script(entry.status, entry.headers.items(), entry.body)
+        else:
+            self.send_response(entry.status)
+            self.send_proxied_headers(entry.headers.items(), ['content-length'])
+            self.send_header('Content-Length', str(entry.size))
+            self.end_headers()
+            self.wfile.write(entry.body)
+        self.server.printer.info("Cache %s: %s (%s)" % (
+            {'hits': 'hit'}.get(outcome, outcome), cacheurl, cache.get_stats()))
+
+    def relay(self, response, has_body=True, limit=None):
+        """
+        Send the status, headers and (undecoded) body of `response` to the
+        client.
+
+        If `limit` is given, the body is also collected and returned, unless
+        it is larger than `limit` bytes.
+        """
+        has_body = has_body and response.status_code not in (204, 304) and response.status_code >= 200
+        if has_body and self.wants_script(response.status_code, response.headers):
+            body = response.raw.read(decode_content=False)
+            self.send_with_script(response.status_code, get_header_items(response), body)
+            if limit is not None and len(body) <= limit:
+                return body
+            return None
         self.send_response(response.status_code)
-        response.headers['content-length'] = str(length)
-        # kill transfer-encoding, this server doesn't support it
-        if 'transfer-encoding' in response.headers:
-            del response.headers['transfer-encoding']
-        # for some reason, sometimes the 'content-encoding' is reported as 
-        # 'gzip' but isn't, so the quickfix is to kill that header.
-        # TODO: Make this not that magical
-        if 'content-encoding' in response.headers:
-            del response.headers['content-encoding']
-        # proxy the headers we got from the initial request
-        for key, value in response.headers.items():
-            self.send_header(key, value)
+        self.send_proxied_headers(get_header_items(response))
+        chunked = False
+        if has_body and 'content-length' not in response.headers:
+            if self.request_version == 'HTTP/1.1':
+                chunked = True
+                self.send_header('Transfer-Encoding', 'chunked')
+            else:
+                self.send_header('Connection', 'close')
+                self.close_connection = 1
         self.end_headers()
-        # send the content
-        self.wfile.write(content)
+        if not has_body:
+            return '' if limit is not None else None
+        collected = []
+        size = 0
+        for chunk in response.raw.stream(STREAM_CHUNKSIZE, decode_content=False):
+            if not chunk:
+                continue
+            if chunked:
+                self.wfile.write('%x\r\n%s\r\n' % (len(chunk), chunk))
+            else:
+                self.wfile.write(chunk)
+            if limit is not None:
+                size += len(chunk)
+                if size > limit:
+                    limit = collected = None
+                else:
+                    collected.append(chunk)
+        if chunked:
+            self.wfile.write('0\r\n\r\n')
+        if limit is not None:
+            return ''.join(collected)
         
+    def wants_script(self, status, headers):
+        """
+        Check whether the live reload script should be injected into a
+        response with `status` and `headers`.
+        """
+        return (self.server.livereload is not None and status == 200 and
+                headers.get('content-type', '').startswith('text/html') and
+                headers.get('content-encoding', 'identity').lower() in INJECTABLE_ENCODINGS)
+
+    def send_with_script(self, status, items, body):
+        """
+        Send the HTML page `body` (encoded as the headers in `items` say) with
+        the live reload script injected.
+        """
+        encoding = CaseInsensitiveDict(items).get('content-encoding', 'identity')
+        html = inject_script(decode_body(body, encoding.lower()))
+        self.send_response(status)
+        self.send_proxied_headers(items, ['content-length', 'content-encoding'])
+        self.send_header('Content-Length', str(len(html)))
+        self.end_headers()
+        self.wfile.write(html)
+
+    def send_proxied_headers(self, items, exclude=()):
+        """
+        Send the headers in `items` we got from the remote site, except for
+        those that only apply to the connection to it and those in `exclude`.
+        Redirects and cookies are rewritten to point to this server.
+        """
+        netloc = urlparse.urlsplit(self.server.proxied_to)[1]
+        for key, value in items:
+            name = key.lower()
+            if name in HOP_BY_HOP_HEADERS or name in exclude:
+                continue
+            if name == 'location':
+                value = rewrite_location(value, netloc)
+            elif name == 'set-cookie':
+                value = rewrite_set_cookie(value)
+            self.send_header(key, value)
+
+    def serve_livereload(self):
+        """
+        Send an event stream of changes in the static folder to the browser,
+        until it disconnects.
+        """
+        queue = self.server.livereload.subscribe()
+        try:
+            self.send_response(200)
+            self.send_header("Content-type", 'text/event-stream')
+            self.send_header("Cache-Control", 'no-cache')
+            self.send_header("Connection", 'close')
+            self.end_headers()
+            self.close_connection = 1
+            self.wfile.write('retry: 1000\n\n')
+            while True:
+                try:
+                    changed = queue.get(timeout=PING_INTERVAL)
+                except Queue.Empty:
+                    self.wfile.write(': ping\n\n')
+                    continue
+                # editors often write several files (or a file several times)
+                time.sleep(DEBOUNCE)
+                changed = set(changed)
+                while True:
+                    try:
+                        changed.update(queue.get_nowait())
+                    except Queue.Empty:
+                        break
+                event, data = get_event(changed)
+                self.server.printer.info("Live reload: %s %s" % (event, ', '.join(data)))
+                self.wfile.write('event: %s\ndata: %s\n\n' % (event, json.dumps(data)))
+        except socket.error:
+            # the browser went away
+            pass
+        finally:
+            self.server.livereload.unsubscribe(queue)
+
     def log_message(self, format, *args):
         self.server.printer.info(format % args)
 
 
-class StaticServer(ForkingMixIn, HTTPServer):
-    def __init__(self, server_address, RequestHandlerClass, proxied_to, staticfolder, printer):
+class ThreadPoolMixIn(object):
+    """
+    Mix-in class to handle requests with a fixed pool of threads, which share
+    the server (and thus its upstream connection pool).
+    """
+    threads = DEFAULT_THREADS
+    daemon_threads = True
+
+    def start_threads(self):
+        self.requests = Queue.Queue(self.threads * 2)
+        for _ in range(self.threads):
+            thread = threading.Thread(target=self.process_request_thread)
+            thread.daemon = self.daemon_threads
+            thread.start()
+
+    def process_request_thread(self):
+        while True:
+            request, client_address = self.requests.get()
+            try:
+                self.finish_request(request, client_address)
+            except:
+                self.handle_error(request, client_address)
+            self.shutdown_request(request)
+
+    def process_request(self, request, client_address):
+        self.requests.put((request, client_address))
+
+
+class StaticServer(HTTPServer):
+    def __init__(self, server_address, RequestHandlerClass, proxied_to, staticfolder, printer,
+                 threads=DEFAULT_THREADS, cache=None, index=None, livereload=None,
+                 session=None, upstream_timeout=None):
         self.proxied_to = proxied_to
+        self.cache = cache
+        self.index = index or StaticIndex(staticfolder)
+        self.livereload = livereload
+        self.gzip_cache = GzipCache()
         self.staticfolder = staticfolder
         self.printer = printer
-        self.session = requests.session()
+        self.threads = threads
+        # by default, allow as many upstream connections as there are threads
+        self.session = session or make_session(max_connections=threads)
+        self.upstream_timeout = upstream_timeout
+        self.stats = UpstreamStats()
+        self.started = time.time()
         self.last = proxied_to
         HTTPServer.__init__(self, server_address, RequestHandlerClass)
 
 
+class ForkingStaticServer(ForkingMixIn, StaticServer):
+    """
+    Forks a process per request. Every child has its own copy of the session,
+    so upstream connections are never reused.
+    """
+
+
+class ThreadedStaticServer(ThreadPoolMixIn, StaticServer):
+    """
+    Handles requests with a pool of threads sharing one upstream session.
+    """
+    def __init__(self, *args, **kwargs):
+        StaticServer.__init__(self, *args, **kwargs)
+        self.start_threads()
+
+
+ENGINES = {
+    'fork': ForkingStaticServer,
+    'thread': ThreadedStaticServer,
+}
+
+
 class Command(BaseCommand):
     help = 'Serve staticfiles from a local folder.'
     option_list = BaseCommand.option_list + (
         make_option('-p', '--port', action='store', dest='port', default='8080',
             help='The port of the server', type=int,
         ),
+        make_option('--engine', action='store', dest='engine', default=DEFAULT_ENGINE,
+            type='choice', choices=sorted(ENGINES.keys()),
+            help='How requests are handled: "thread" (a pool of threads sharing upstream connections) or "fork" (a process per request).'
+        ),
+        make_option('--threads', action='store', dest='threads', default=DEFAULT_THREADS,
+            type='int', help='Number of threads of the "thread" engine.'
+        ),
+        make_option('--poll-interval', action='store', dest='poll_interval', default=POLL_INTERVAL,
+            type='float', help='Seconds between scans of the static folder for changes if pyinotify is not installed.'
+        ),
+        make_option('--follow-symlinks', action='store_true', dest='follow_symlinks', default=False,
+            help='Also serve files from directories linked from the static folder which are outside of it.'
+        ),
+        make_option('--pool-connections', action='store', dest='pool_connections', default=DEFAULT_POOL_CONNECTIONS,
+            type='int', help='Number of hosts to keep connections to.'
+        ),
+        make_option('--max-connections', action='store', dest='max_connections', default=None,
+            type='int', help='Maximum number of connections per host, defaults to the number of threads.'
+        ),
+        make_option('--connect-timeout', action='store', dest='connect_timeout', default=DEFAULT_CONNECT_TIMEOUT,
+            type='float', help='Seconds to wait for a connection to the website.'
+        ),
+        make_option('--read-timeout', action='store', dest='read_timeout', default=DEFAULT_READ_TIMEOUT,
+            type='float', help='Seconds to wait for data from the website.'
+        ),
+        make_option('--retries', action='store', dest='retries', default=DEFAULT_RETRIES,
+            type='int', help='How often failed connections and reads of GET requests to the website are retried.'
+        ),
+        make_option('--retry-backoff', action='store', dest='retry_backoff', default=DEFAULT_RETRY_BACKOFF,
+            type='float', help='Backoff factor for retries, the n-th retry waits backoff * 2 ** (n - 1) seconds.'
+        ),
+        make_option('--livereload', action='store_true', dest='livereload', default=False,
+            help='Inject a script into proxied pages which applies changed stylesheets and reloads the page when other files in the static folder change. Requires the "thread" engine.'
+        ),
+        make_option('--cache-size', action='store', dest='cache_size', default=DEFAULT_CACHE_SIZE,
+            type='int', help='Size of the in memory cache for proxied GET responses in MB, 0 disables the cache.'
+        ),
+        make_option('--cache-dir', action='store', dest='cache_dir', default=None,
+            help='Also keep cached responses in this directory, so they survive restarts.'
+        ),
     )
     
 
@@ -158,12 +683,30 @@ class Command(BaseCommand):
             raise CommandError("You must provide the url to your website file as first argument")
         if not os.path.exists(staticfolder):
             raise CommandError("Static folder %r not found." % staticfolder)
+        if options['livereload'] and options['engine'] != 'thread':
+            raise CommandError("--livereload requires the thread engine.")
         server_address = ('', int(options['port']))
         printer = Printer(int(options['verbosity']))
         print "Open http://localhost:%s in your browser" % options['port']
         print "Use ctrl+c to stop the server"
-        httpd = StaticServer(server_address, StaticHandler, url, staticfolder, printer)
+        cache = None
+        if options['cache_size'] > 0:
+            cache = ResponseCache(options['cache_size'], options['cache_dir'])
+        index = StaticIndex(staticfolder, options['poll_interval'], printer, options['follow_symlinks'])
+        printer.info("Watching %r for changes using %s" % (staticfolder, index.start()))
+        livereload = None
+        if options['livereload']:
+            livereload = LiveReload()
+            index.listeners.append(livereload.notify)
+        session = make_session(options['pool_connections'], options['max_connections'] or options['threads'],
+                               options['retries'], options['retry_backoff'])
+        timeout = (options['connect_timeout'], options['read_timeout'])
+        server_class = ENGINES[options['engine']]
+        httpd = server_class(server_address, StaticHandler, url, staticfolder, printer,
+                             options['threads'], cache, index, livereload, session, timeout)
         try:
             httpd.serve_forever()
         except KeyboardInterrupt:
+            if cache is not None:
+                printer.info("Cache: %s" % cache.get_stats())
             printer.always("Server shut down")
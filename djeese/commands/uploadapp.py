@@ -2,15 +2,90 @@
 from __future__ import with_statement
 from djeese import errorcodes
 from djeese.apps import AppConfiguration
-from djeese.commands import BaseCommand, CommandError, LOGIN_PATH
-from djeese.printer import Printer
+from djeese.commands import BaseCommand, CommandError
+from djeese.compression import (COMPRESSION_CHOICES, DEFAULT_COMPRESSION,
+    DEFAULT_LEVEL)
+from djeese.printer import BufferedPrinter, Printer
+from djeese.sdist import SdistCache
+from djeese.streaming import SizedMultipartStream, iter_file
+from djeese.upload import ChunkedUploader, UploadError, UPLOAD_OPTIONS
+from djeese.upstream import make_session
 from djeese.utils import bundle_app
+from multiprocessing import Pool, cpu_count
+from multiprocessing.pool import ThreadPool
+from itertools import izip
 from optparse import make_option
+import hashlib
 import os
 import requests
+import shutil
+import tempfile
+import time
+import traceback
 
 
 UPLOAD_PATH = '/api/v1/apps/upload-bundle/'
+try:
+    DEFAULT_JOBS = cpu_count()
+except NotImplementedError:
+    DEFAULT_JOBS = 1
+
+
+def read_manifest(path):
+    """
+    Read a batch manifest: one app per line as the path to its setup.py and
+    the path to its app file, relative to the manifest. Empty lines and lines
+    starting with # are ignored. Returns a list of (setupfile, appfile)
+    tuples.
+    """
+    basedir = os.path.dirname(os.path.abspath(path))
+    apps = []
+    with open(path) as fobj:
+        for number, line in enumerate(fobj):
+            line = line.strip()
+            if not line or line.startswith('#'):
+                continue
+            paths = line.split()
+            if len(paths) != 2:
+                raise CommandError("Line %s of %r must contain the path to a setup.py and an app file" % (number + 1, path))
+            apps.append(tuple([os.path.join(basedir, bit) for bit in paths]))
+    return apps
+
+def get_app_source(setupfile, appfile):
+    """
+    Fingerprint of the app file and the sources of the package of an app, so
+    an interrupted upload is not resumed after either changed.
+    """
+    digest = hashlib.sha256()
+    with open(appfile, 'rb') as fobj:
+        digest.update(fobj.read())
+    digest.update(SdistCache().get_digest(setupfile))
+    return digest.hexdigest()
+
+def build_bundle_file(args):
+    """
+    Validate and bundle an app into a file at `bundlepath`. Runs in the
+    worker processes of a batch upload, so it takes a single tuple and returns
+    a tuple of (appname, bundlepath, error), where bundlepath is None and
+    error a message if the app could not be bundled.
+    """
+    setupfile, appfile, bundlepath, compression, level = args
+    printer = BufferedPrinter(0)
+    try:
+        config = AppConfiguration(printer=printer)
+        config.read(appfile)
+        appname = config['app'].get('name', appfile)
+        if not config.validate():
+            return appname, None, (printer.errors or printer.warnings or ["Invalid configuration"])[0]
+        bundle = bundle_app(setupfile, config, compression, level)
+        try:
+            with open(bundlepath, 'wb') as fobj:
+                shutil.copyfileobj(bundle, fobj)
+        finally:
+            bundle.close()
+    except Exception, e:
+        return appfile, None, "Could not bundle the app: %s" % e
+    return appname, bundlepath, None
 
 
 class Command(BaseCommand):
@@ -19,31 +94,94 @@ class Command(BaseCommand):
         make_option( '--noinput', action='store_true', dest='noinput', default=False,
             help='Do not ask for input. Always assume yes.'
         ),
-    )
-
-    def handle(self, setupfile=None, appfile=None, **options):
-        if not setupfile:
-            raise CommandError("You must provide the path to your apps setup.py as first argument")
-        if not appfile:
-            raise CommandError("You must provide the path to your app file as first argument")
-        if not os.path.exists(setupfile):
-            raise CommandError("Could not find setup.py at %r" % setupfile)
-        if not os.path.exists(appfile):
-            raise CommandError("Could not find setup.py at %r" % appfile)
-        username, password = self.get_auth(options['noinput'])
-        self.run(setupfile, appfile, username, password, **options)
-
-    def run(self, setupfile, appfile, username, password, **options):
+        make_option('--compression', action='store', dest='compression', default=DEFAULT_COMPRESSION,
+            type='choice', choices=COMPRESSION_CHOICES,
+            help='How to compress the bundle: gzip, pgzip (gzip using multiple threads) or store (no compression).'
+        ),
+        make_option('--compression-level', action='store', dest='compression_level', default=DEFAULT_LEVEL,
+            type='int', help='gzip compression level (0-9, 0 stores without compressing).'
+        ),
+        make_option('--manifest', action='store', dest='manifest', default=None,
+            help='Upload all apps listed in this file, one "<setup.py> <appfile>" pair per line.'
+        ),
+        make_option('--jobs', action='store', dest='jobs', default=DEFAULT_JOBS,
+            type='int', help='Number of apps bundled in parallel when uploading several apps. Defaults to the number of CPUs.'
+        ),
+    ) + UPLOAD_OPTIONS
+    args = '<setup.py> <appfile> [<setup.py> <appfile> ...]'
+
+    def handle(self, *args, **options):
+        if not 0 <= options['compression_level'] <= 9:
+            raise CommandError("--compression-level must be between 0 and 9")
+        if options['manifest']:
+            if args:
+                raise CommandError("Apps can either be given as arguments or in a manifest")
+            if not os.path.exists(options['manifest']):
+                raise CommandError("Could not find manifest at %r" % options['manifest'])
+            apps = read_manifest(options['manifest'])
+        else:
+            if not args:
+                raise CommandError("You must provide the path to your apps setup.py as first argument")
+            if len(args) % 2:
+                raise CommandError("You must provide the path to your app file as second argument")
+            apps = zip(args[::2], args[1::2])
+        for setupfile, appfile in apps:
+            if not os.path.exists(setupfile):
+                raise CommandError("Could not find setup.py at %r" % setupfile)
+            if not os.path.exists(appfile):
+                raise CommandError("Could not find app file at %r" % appfile)
+        if len(apps) > 1 or options['manifest']:
+            if options['resumable']:
+                raise CommandError("Resumable uploads can only be used for a single app")
+            self.run_batch(apps, **options)
+            return
+        setupfile, appfile = apps[0]
+        self.run(setupfile, appfile, **options)
+
+    def run(self, setupfile, appfile, **options):
         printer = Printer(int(options['verbosity']), logfile='djeese.log')
+        session = self.get_session(options['noinput'])
+        if session is None:
+            printer.error("Authentication failed")
+            printer.always("Upload failed")
+            return
         config = AppConfiguration(printer=printer)
         config.read(appfile)
-        bundle = bundle_app(setupfile, config) 
+        def build_bundle():
+            try:
+                return bundle_app(setupfile, config, options['compression'],
+                                  options['compression_level'], printer=printer)
+            except IOError, e:
+                raise CommandError("Could not bundle the app: %s" % e)
         appname = config['app']['name']
-        response = self.upload(appname, bundle, username, password)
+        if options['resumable']:
+            try:
+                response = self.upload_resumable(appname, build_bundle,
+                    lambda: get_app_source(setupfile, appfile), session, printer, **options)
+            except UploadError, e:
+                printer.error(str(e))
+                if e.response is not None:
+                    printer.log_only(e.response.content)
+                printer.always("Upload interrupted, run the same command again to resume it")
+                return
+        else:
+            bundle = build_bundle()
+            try:
+                response = self.upload(appname, bundle, session)
+            finally:
+                bundle.close()
+        self.report_response(response, printer)
+
+    def report_response(self, response, printer):
+        """
+        Print the outcome of an upload. Returns True if it was successful.
+        """
         if response.status_code == 201:
             printer.always("Upload successful (created)")
+            return True
         elif response.status_code == 204:
             printer.always("Upload successful (updated)")
+            return True
         elif response.status_code == 400:
             self.handle_bad_request(response, printer)
             printer.always("Upload failed")
@@ -57,6 +195,90 @@ class Command(BaseCommand):
             printer.error("Unexpected response: %s" % response.status_code)
             printer.log_only(response.content)
             printer.always("Upload failed, check djeese.log for more details")
+        return False
+
+    def run_batch(self, apps, **options):
+        """
+        Upload several apps, given as a list of (setupfile, appfile) tuples.
+
+        The apps are bundled in `jobs` processes and uploaded as soon as their
+        bundle is ready, `upload_workers` at a time, over a single logged in
+        session. A summary is printed at the end.
+        """
+        printer = Printer(int(options['verbosity']), logfile='djeese.log')
+        workers = max(1, options['upload_workers'])
+        session = self.get_session(options['noinput'],
+            make_session(max_connections=workers, retries=0, keep_cookies=True))
+        if session is None:
+            printer.error("Authentication failed")
+            printer.always("Upload failed")
+            return
+        workspace = tempfile.mkdtemp(prefix='djeese')
+        tasks = [(setupfile, appfile, os.path.join(workspace, '%s.bundle' % index),
+                  options['compression'], options['compression_level'])
+                 for index, (setupfile, appfile) in enumerate(apps)]
+        jobs = max(1, min(options['jobs'], len(apps)))
+        start = time.time()
+        bundler = Pool(jobs)
+        uploader = ThreadPool(workers)
+        try:
+            uploads = []
+            for (setupfile, appfile), (appname, bundlepath, error) in izip(apps, bundler.imap(build_bundle_file, tasks)):
+                if error is not None:
+                    printer.error("%s: %s" % (appname, error))
+                    uploads.append((appname, setupfile, None, error))
+                    continue
+                printer.info("%s: bundled" % appname)
+                result = uploader.apply_async(self.upload_bundle_file, (session, appname, bundlepath))
+                uploads.append((appname, setupfile, result, None))
+            results = []
+            for appname, setupfile, result, error in uploads:
+                if result is None:
+                    success, status = False, error
+                else:
+                    try:
+                        success, status = result.get()
+                    except Exception, e:
+                        success, status = False, "Upload failed: %s" % e
+                        traceback.print_exc(file=printer.logfile)
+                    if success:
+                        printer.info("%s: %s" % (appname, status))
+                    else:
+                        printer.error("%s: %s" % (appname, status))
+                results.append((appname, setupfile, success, status))
+        finally:
+            bundler.terminate()
+            bundler.join()
+            uploader.close()
+            uploader.join()
+            shutil.rmtree(workspace)
+        self.print_summary(results, printer)
+        printer.info("%s apps processed in %.1fs" % (len(apps), time.time() - start))
+
+    def upload_bundle_file(self, session, appname, bundlepath):
+        """
+        Upload the bundle at `bundlepath` with a logged in `session`. Returns a
+        tuple of whether the upload was successful and a status message.
+        """
+        printer = BufferedPrinter(0)
+        try:
+            with open(bundlepath, 'rb') as bundle:
+                response = self.upload(appname, bundle, session)
+        except requests.RequestException, e:
+            return False, "Upload failed: %s" % e
+        if self.report_response(response, printer):
+            return True, printer.lines[-1]
+        return False, (printer.errors or ["Upload failed"])[0]
+
+    def print_summary(self, results, printer):
+        width = max([len(appname) for appname, _, _, _ in results] + [len('App')])
+        row = '%%-%ds  %%-7s  %%s' % width
+        printer.always('')
+        printer.always(row % ('App', 'Result', 'Details'))
+        for appname, setupfile, success, status in results:
+            printer.always(row % (appname, 'ok' if success else 'FAILED', status))
+        failed = len([result for result in results if not result[2]])
+        printer.always("%s apps uploaded, %s failed" % (len(results) - failed, failed))
     
     def handle_bad_request(self, response, printer):
         code = int(response.headers.get('X-DJEESE-ERROR-CODE', 0))
@@ -91,18 +313,46 @@ class Command(BaseCommand):
             printer.error("Unexpected error code: %s (%s)" % (code, meta))
         printer.info(response.content)
 
-    def upload(self, appname, bundle, username, password):
-        files = {
-            'bundle': bundle,
-        }
+    def upload(self, appname, bundle, session):
+        response = self.post_bundle(session, appname, bundle)
+        if response.status_code == 403 and self.relogin(session, response.request):
+            # the stored session expired
+            response = self.post_bundle(session, appname, bundle)
+        return response
+
+    def post_bundle(self, session, appname, bundle):
+        """
+        Upload the file like `bundle` with a logged in `session`.
+        """
         data = {
             'app': appname,
         }
-        session = requests.session()
-        login_url = self.get_absolute_url(LOGIN_PATH)
-        response = session.post(login_url, {'username': username, 'password': password})
-        if response.status_code != 204:
-            return response
+        bundle.seek(0, os.SEEK_END)
+        length = bundle.tell()
+        bundle.seek(0)
+        # streamed from the (possibly spooled) bundle instead of copied into
+        # an encoded multipart body
+        body = SizedMultipartStream(data, 'bundle', 'bundle', iter_file(bundle), length)
         target_url = self.get_absolute_url(UPLOAD_PATH)
-        response = session.post(target_url, data=data, files=files)
+        response = session.post(target_url, data=body, headers={'Content-Type': body.content_type})
         return response
+
+    def upload_resumable(self, appname, build_bundle, get_source, session, printer, **options):
+        """
+        Like upload, but uploads the bundle returned by `build_bundle` in
+        parts, or resumes an interrupted upload of this app if `get_source`
+        (see get_app_source) returns what it did when that one was started.
+        """
+        uploader = ChunkedUploader(session, self.get_absolute_url, 'app-%s' % appname,
+            printer, options['part_size'], options['upload_workers'])
+        if options['restart']:
+            uploader.discard()
+        state = uploader.load_state()
+        if state and uploader.check_source(state, get_source()):
+            return uploader.resume(state)
+        bundle = build_bundle()
+        try:
+            # after building, the sources of the package are known
+            return uploader.upload(bundle, {'kind': 'app', 'app': appname}, source=get_source())
+        finally:
+            bundle.close()
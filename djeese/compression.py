@@ -0,0 +1,173 @@
+# -*- coding: utf-8 -*-
+from multiprocessing.pool import ThreadPool
+import struct
+import time
+import zlib
+
+COMPRESSION_CHOICES = ['gzip', 'pgzip', 'store']
+DEFAULT_COMPRESSION = 'gzip'
+DEFAULT_LEVEL = 9
+BLOCKSIZE = 128 * 1024
+DEFAULT_WORKERS = 4
+# Extensions of files that are already compressed and not worth deflating
+PRECOMPRESSED_EXTENSIONS = ['.png', '.jpg', '.jpeg', '.gif', '.gz', '.zip']
+
+
+def is_precompressed(name):
+    """
+    Check whether the file `name` is already compressed, judging by its
+    extension.
+    """
+    return name.lower().endswith(tuple(PRECOMPRESSED_EXTENSIONS))
+
+def _deflate_block(args):
+    """
+    Deflate a single block as raw deflate data which can be concatenated with
+    other blocks.
+    """
+    data, level = args
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS)
+    return compressor.compress(data) + compressor.flush(zlib.Z_SYNC_FLUSH)
+
+
+class StoreWriter(object):
+    """
+    Write-only file like object passing data through to `fileobj` unchanged,
+    used for the 'store' compression.
+    """
+    def __init__(self, fileobj):
+        self.fileobj = fileobj
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.started = time.time()
+
+    def write(self, data):
+        self.bytes_in += len(data)
+        self.bytes_out += len(data)
+        self.fileobj.write(data)
+
+    def tell(self):
+        return self.bytes_in
+
+    def set_level(self, level=None):
+        pass
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.elapsed = time.time() - self.started
+
+
+class GzipWriter(StoreWriter):
+    """
+    Write-only file like object writing a standard, single member gzip stream
+    to `fileobj`.
+
+    If `workers` is more than 1, the data is split into blocks of `blocksize`
+    bytes which are deflated concurrently by that many threads and
+    concatenated, like pigz does. The compression level can be changed
+    between writes using set_level, eg to store already compressed data.
+    """
+    def __init__(self, fileobj, level=DEFAULT_LEVEL, workers=1, blocksize=BLOCKSIZE):
+        super(GzipWriter, self).__init__(fileobj)
+        self.default_level = self.level = level
+        self.workers = workers
+        self.blocksize = blocksize
+        self.crc = zlib.crc32('') & 0xffffffff
+        self.compressor = None
+        self.pending = []
+        self.pending_size = 0
+        self.results = []
+        self.pool = ThreadPool(workers) if workers > 1 else None
+        xfl = '\002' if level == 9 else ('\004' if level == 1 else '\000')
+        self._write_out('\037\213\010\000%s%s\377' % (struct.pack('<L', long(time.time())), xfl))
+
+    def _write_out(self, data):
+        self.bytes_out += len(data)
+        self.fileobj.write(data)
+
+    def set_level(self, level=None):
+        """
+        Set the compression level for subsequent writes. If `level` is None,
+        the level given to the constructor is used.
+        """
+        if level is None:
+            level = self.default_level
+        if level == self.level:
+            return
+        if self.pool is not None:
+            self._submit()
+        elif self.compressor is not None:
+            self._write_out(self.compressor.flush(zlib.Z_SYNC_FLUSH))
+            self.compressor = None
+        self.level = level
+
+    def write(self, data):
+        if not data:
+            return
+        self.bytes_in += len(data)
+        self.crc = zlib.crc32(data, self.crc) & 0xffffffff
+        if self.pool is None:
+            if self.compressor is None:
+                self.compressor = zlib.compressobj(self.level, zlib.DEFLATED, -zlib.MAX_WBITS)
+            self._write_out(self.compressor.compress(data))
+            return
+        self.pending.append(data)
+        self.pending_size += len(data)
+        if self.pending_size >= self.blocksize:
+            self._submit()
+
+    def _submit(self):
+        """
+        Hand the pending data to the pool and write out finished blocks,
+        keeping at most two blocks per worker in flight.
+        """
+        if self.pending:
+            data = ''.join(self.pending)
+            self.pending = []
+            self.pending_size = 0
+            for start in range(0, len(data), self.blocksize):
+                block = data[start:start + self.blocksize]
+                self.results.append(self.pool.apply_async(_deflate_block, ((block, self.level),)))
+        while len(self.results) > self.workers * 2:
+            self._write_out(self.results.pop(0).get())
+
+    def close(self):
+        if self.pool is not None:
+            self._submit()
+            for result in self.results:
+                self._write_out(result.get())
+            self.results = []
+            self.pool.close()
+            self.pool.join()
+        elif self.compressor is not None:
+            self._write_out(self.compressor.flush(zlib.Z_SYNC_FLUSH))
+        # an empty final block terminates the deflate stream
+        self._write_out(zlib.compressobj(self.default_level, zlib.DEFLATED, -zlib.MAX_WBITS).flush(zlib.Z_FINISH))
+        self._write_out(struct.pack('<LL', self.crc, self.bytes_in & 0xffffffff))
+        self.elapsed = time.time() - self.started
+
+
+def get_writer(fileobj, compression=DEFAULT_COMPRESSION, level=DEFAULT_LEVEL, workers=DEFAULT_WORKERS):
+    """
+    Return a write-only file like object for `fileobj` compressing the data
+    written to it according to `compression` (one of COMPRESSION_CHOICES).
+    `workers` is only used by 'pgzip'.
+
+    Once closed, the writer has the attributes bytes_in, bytes_out and elapsed.
+    """
+    if compression == 'store':
+        return StoreWriter(fileobj)
+    if compression == 'pgzip':
+        return GzipWriter(fileobj, level, workers)
+    return GzipWriter(fileobj, level)
+
+def report_throughput(writer, printer):
+    """
+    Print the throughput of a closed writer returned by get_writer.
+    """
+    megabytes = writer.bytes_in / (1024.0 * 1024.0)
+    printer.info("Compressed %.1f MB to %.1f MB in %.2fs (%.1f MB/s)" % (
+        megabytes, writer.bytes_out / (1024.0 * 1024.0), writer.elapsed,
+        megabytes / writer.elapsed if writer.elapsed else 0))
@@ -0,0 +1,87 @@
+# -*- coding: utf-8 -*-
+from __future__ import with_statement
+from djeese.compression import DEFAULT_LEVEL, is_precompressed
+import gzip
+import os
+import shutil
+
+CACHE_DIR = os.path.join(os.path.expanduser('~'), '.djeese-cache')
+CACHE_MAX_SIZE = 1024 * 1024 * 1024
+
+
+class ContentCache(object):
+    """
+    Content addressed store of gzipped file contents, keyed by their SHA-256
+    hash, so the same content only has to be compressed once, no matter how
+    many websites it is pushed to.
+    """
+    def __init__(self, root=CACHE_DIR, max_size=CACHE_MAX_SIZE):
+        self.root = root
+        self.max_size = max_size
+
+    def get_path(self, hexdigest):
+        """
+        Return the path of the cached blob for `hexdigest`.
+        """
+        return os.path.join(self.root, hexdigest[:2], '%s.gz' % hexdigest)
+
+    def get_blob(self, hexdigest, filepath, level=DEFAULT_LEVEL):
+        """
+        Return a tuple of (path, name) for the blob of the file at `filepath`
+        with the hash `hexdigest`, compressing it into the cache if it isn't
+        there yet.
+
+        Files which are already compressed are not cached, for those the path
+        is `filepath` itself and the name the hash, for all others the name
+        has a '.gz' suffix.
+        """
+        if is_precompressed(filepath):
+            return filepath, hexdigest
+        blobpath = self.get_path(hexdigest)
+        if os.path.exists(blobpath):
+            # mark as recently used for prune()
+            os.utime(blobpath, None)
+            return blobpath, '%s.gz' % hexdigest
+        dirname = os.path.dirname(blobpath)
+        if not os.path.exists(dirname):
+            os.makedirs(dirname)
+        tmppath = '%s.%s.tmp' % (blobpath, os.getpid())
+        with open(filepath, 'rb') as source:
+            with open(tmppath, 'wb') as target:
+                # mtime=0 keeps the blob identical for identical content
+                gzfile = gzip.GzipFile('', 'wb', level, target, mtime=0)
+                try:
+                    shutil.copyfileobj(source, gzfile)
+                finally:
+                    gzfile.close()
+        os.rename(tmppath, blobpath)
+        return blobpath, '%s.gz' % hexdigest
+
+    def prune(self):
+        """
+        Remove the least recently used blobs until the cache is no larger than
+        max_size bytes.
+        """
+        prune_directory(self.root, self.max_size)
+
+
+def prune_directory(root, max_size):
+    """
+    Remove the least recently modified files below `root` until their total
+    size is no larger than `max_size` bytes.
+    """
+    if not os.path.exists(root):
+        return
+    files = []
+    total = 0
+    for dirpath, dirnames, filenames in os.walk(root):
+        for filename in filenames:
+            path = os.path.join(dirpath, filename)
+            stat = os.stat(path)
+            files.append((stat.st_mtime, stat.st_size, path))
+            total += stat.st_size
+    files.sort()
+    while files and total > max_size:
+        mtime, size, path = files.pop(0)
+        os.remove(path)
+        total -= size
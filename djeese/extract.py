@@ -0,0 +1,209 @@
+# -*- coding: utf-8 -*-
+from __future__ import with_statement
+from multiprocessing.pool import ThreadPool
+import os
+import posixpath
+import shutil
+import threading
+import time
+
+DEFAULT_WORKERS = 4
+DEFAULT_MAX_INFLIGHT = 32
+PROGRESS_INTERVAL = 1.0
+STREAM_CHUNKSIZE = 64 * 1024
+
+
+def safe_join(root, name):
+    """
+    Join `root` and the relative path `name`, refusing names which would end
+    up outside of `root`.
+    """
+    target = os.path.normpath(os.path.join(root, name))
+    normroot = os.path.normpath(root)
+    if os.path.isabs(name) or not (target == normroot or target.startswith(normroot + os.sep)):
+        raise ValueError("Refusing to write %r outside of %r" % (name, root))
+    return target
+
+def check_realpath(root, path):
+    """
+    Refuse `path` if it is outside of `root` once symlinks are resolved, eg
+    because a directory on the way is a symlink.
+    """
+    realroot = os.path.realpath(root)
+    realpath = os.path.realpath(path)
+    if not (realpath == realroot or realpath.startswith(realroot + os.sep)):
+        raise ValueError("Refusing to write %r outside of %r" % (path, root))
+    return path
+
+def check_link(root, tarinfo):
+    """
+    Refuse the symlink or hardlink member `tarinfo` if it points outside of
+    `root`. Symlinks are relative to the directory of the member, hardlinks to
+    the root of the archive.
+    """
+    if os.path.isabs(tarinfo.linkname):
+        raise ValueError("Refusing link %r to absolute path %r" % (tarinfo.name, tarinfo.linkname))
+    if tarinfo.issym():
+        linkname = posixpath.join(posixpath.dirname(tarinfo.name), tarinfo.linkname)
+    else:
+        linkname = tarinfo.linkname
+    try:
+        safe_join(root, linkname)
+        # not normalized, so symlinks followed by '..' are resolved first
+        check_realpath(root, os.path.join(root, linkname))
+    except ValueError:
+        raise ValueError("Refusing link %r to %r outside of %r" % (tarinfo.name, tarinfo.linkname, root))
+
+
+class CountingReader(object):
+    """
+    Wraps a file like object and counts the bytes read from it.
+    """
+    def __init__(self, fileobj):
+        self.fileobj = fileobj
+        self.bytes_read = 0
+
+    def read(self, size=-1):
+        data = self.fileobj.read(size)
+        self.bytes_read += len(data)
+        return data
+
+
+class ByteBudget(object):
+    """
+    Limits the number of bytes in flight between threads. A single item
+    larger than the limit is allowed if nothing else is in flight.
+    """
+    def __init__(self, limit):
+        self.limit = limit
+        self.inflight = 0
+        self.condition = threading.Condition()
+
+    def acquire(self, size):
+        with self.condition:
+            while self.inflight and self.inflight + size > self.limit:
+                self.condition.wait()
+            self.inflight += size
+
+    def release(self, size):
+        with self.condition:
+            self.inflight -= size
+            self.condition.notify_all()
+
+
+class ParallelExtractor(object):
+    """
+    Extracts a tarball opened in stream mode (eg 'r|gz') into `outputdir`.
+
+    The calling thread reads and decompresses the members and hands the file
+    contents to `workers` writer threads, keeping at most `max_inflight` MB
+    of file contents in memory. Files larger than that are written by the
+    calling thread itself, in chunks. Progress (bytes/s, files/s and, if the total
+    size of the compressed stream is known, an ETA) is reported to the
+    printer every PROGRESS_INTERVAL seconds.
+    """
+    def __init__(self, outputdir, printer, workers=DEFAULT_WORKERS,
+                 max_inflight=DEFAULT_MAX_INFLIGHT):
+        self.outputdir = outputdir
+        self.printer = printer
+        self.workers = workers
+        self.budget = ByteBudget(max_inflight * 1024 * 1024)
+        self.lock = threading.Lock()
+        self.errors = []
+        self.files = 0
+        self.bytes_written = 0
+
+    def open_target(self, target):
+        # a link extracted in the meantime may have changed where it ends up
+        check_realpath(self.outputdir, target)
+        dirname = os.path.dirname(target)
+        if not os.path.isdir(dirname):
+            try:
+                os.makedirs(dirname)
+            except OSError:
+                # created by another writer in the meantime
+                if not os.path.isdir(dirname):
+                    raise
+        return open(target, 'wb')
+
+    def finish_file(self, target, tarinfo):
+        os.chmod(target, tarinfo.mode & 07777)
+        os.utime(target, (tarinfo.mtime, tarinfo.mtime))
+        with self.lock:
+            self.files += 1
+            self.bytes_written += tarinfo.size
+
+    def write_file(self, target, data, tarinfo):
+        try:
+            with self.open_target(target) as fobj:
+                fobj.write(data)
+            self.finish_file(target, tarinfo)
+        except Exception, e:
+            with self.lock:
+                self.errors.append(e)
+        finally:
+            self.budget.release(tarinfo.size)
+
+    def stream_file(self, target, fileobj, tarinfo):
+        """
+        Write a file too large for the budget from the calling thread, without
+        reading it into memory.
+        """
+        with self.open_target(target) as fobj:
+            shutil.copyfileobj(fileobj, fobj, STREAM_CHUNKSIZE)
+        self.finish_file(target, tarinfo)
+
+    def report(self, started, reader, total, final=False):
+        elapsed = max(time.time() - started, 0.001)
+        with self.lock:
+            files, written = self.files, self.bytes_written
+        message = "%s file(s), %.1f MB written, %.1f MB/s, %.1f files/s" % (
+            files, written / (1024.0 * 1024.0), written / elapsed / (1024.0 * 1024.0),
+            files / elapsed)
+        if total and not final and reader is not None and reader.bytes_read:
+            eta = (total - reader.bytes_read) * elapsed / reader.bytes_read
+            message += ", ETA %ds" % eta
+        self.printer.info(message)
+
+    def extract(self, tarball, reader=None, total=None):
+        """
+        Extract all members of `tarball`. `reader` is the CountingReader the
+        tarball reads from and `total` the size of the compressed stream, both
+        are only used for the ETA.
+
+        Raises the first error a writer thread ran into, if any.
+        """
+        pool = ThreadPool(self.workers)
+        started = last_report = time.time()
+        try:
+            for tarinfo in tarball:
+                target = check_realpath(self.outputdir, safe_join(self.outputdir, tarinfo.name))
+                if tarinfo.isreg() and tarinfo.size > self.budget.limit:
+                    self.stream_file(target, tarball.extractfile(tarinfo), tarinfo)
+                elif tarinfo.isreg():
+                    # wait for room before reading, so the budget bounds memory
+                    self.budget.acquire(tarinfo.size)
+                    try:
+                        data = tarball.extractfile(tarinfo).read()
+                    except:
+                        self.budget.release(tarinfo.size)
+                        raise
+                    pool.apply_async(self.write_file, (target, data, tarinfo))
+                elif tarinfo.isdir():
+                    if not os.path.isdir(target):
+                        os.makedirs(target)
+                else:
+                    if tarinfo.issym() or tarinfo.islnk():
+                        check_link(self.outputdir, tarinfo)
+                    tarball.extract(tarinfo, self.outputdir)
+                if self.errors:
+                    break
+                if time.time() - last_report > PROGRESS_INTERVAL:
+                    self.report(started, reader, total)
+                    last_report = time.time()
+        finally:
+            pool.close()
+            pool.join()
+        if self.errors:
+            raise self.errors[0]
+        self.report(started, reader, total, final=True)
@@ -0,0 +1,170 @@
+# -*- coding: utf-8 -*-
+from __future__ import with_statement
+from StringIO import StringIO
+import errno
+import gzip
+import select
+import socket
+import threading
+try:
+    from os import sendfile
+except ImportError:
+    try:
+        from sendfile import sendfile
+    except ImportError: # sendfile is optional
+        sendfile = None
+
+COPY_CHUNKSIZE = 64 * 1024
+GZIP_LEVEL = 6
+# files smaller than this are not worth compressing
+GZIP_MIN_SIZE = 256
+GZIP_CACHE_SIZE = 32
+# content types compressed on the fly, besides text/*
+COMPRESSIBLE_TYPES = ['application/javascript', 'application/json', 'application/x-javascript',
+                      'application/xml', 'image/svg+xml']
+# precompressed siblings, in order of preference, as (encoding, extension)
+PRECOMPRESSED_SIBLINGS = [('br', '.br'), ('gzip', '.gz')]
+
+
+def get_etag(stat, encoding=None):
+    """
+    Return a strong ETag for a file with the os.stat result `stat`, served
+    with the content-encoding `encoding`.
+    """
+    etag = '%x-%x' % (int(stat.st_mtime), stat.st_size)
+    if encoding:
+        etag = '%s-%s' % (etag, encoding)
+    return '"%s"' % etag
+
+def accepts_encoding(header, encoding):
+    """
+    Check whether the Accept-Encoding `header` allows `encoding`.
+    """
+    for part in (header or '').split(','):
+        params = part.split(';')
+        if params[0].strip().lower() not in (encoding, '*'):
+            continue
+        for param in params[1:]:
+            name, _, value = param.partition('=')
+            if name.strip() == 'q':
+                try:
+                    return float(value) > 0
+                except ValueError:
+                    return False
+        return True
+    return False
+
+def is_compressible(ctype):
+    return ctype.startswith('text/') or ctype in COMPRESSIBLE_TYPES
+
+def parse_range(header, size):
+    """
+    Parse the Range `header` for a file of `size` bytes into a tuple of the
+    first and last byte position.
+
+    Returns None if the header should be ignored (it is invalid or asks for
+    multiple ranges) and raises ValueError if the range is unsatisfiable.
+    """
+    unit, _, ranges = header.partition('=')
+    if unit.strip() != 'bytes' or ',' in ranges:
+        return None
+    first, _, last = [value.strip() for value in ranges.partition('-')]
+    if not (first or last) or not (first.isdigit() or not first) or not (last.isdigit() or not last):
+        return None
+    if not first:
+        # suffix range: the last `last` bytes
+        length = int(last)
+        if not length or not size:
+            raise ValueError("Empty suffix range")
+        return max(0, size - length), size - 1
+    first = int(first)
+    if first >= size:
+        raise ValueError("Range starts after the end of the file")
+    last = int(last) if last else size - 1
+    if last < first:
+        return None
+    return first, min(last, size - 1)
+
+def send_range(connection, wfile, fobj, offset, count):
+    """
+    Send `count` bytes of `fobj` starting at `offset` to the socket
+    `connection`, using sendfile if available, otherwise through `wfile`.
+    """
+    if sendfile is not None:
+        sent = 0
+        try:
+            while sent < count:
+                try:
+                    done = sendfile(connection.fileno(), fobj.fileno(), offset + sent, count - sent)
+                except OSError, e:
+                    if e.errno != errno.EAGAIN:
+                        raise
+                    # sockets with a timeout are non-blocking
+                    if not select.select([], [connection], [], connection.gettimeout())[1]:
+                        raise socket.timeout("timed out")
+                    continue
+                if not done:
+                    break
+                sent += done
+            return
+        except OSError, e:
+            # not supported for this kind of file or socket
+            if sent or e.errno not in (errno.EINVAL, errno.ENOSYS, errno.ENOTSOCK):
+                raise
+    fobj.seek(offset)
+    while count > 0:
+        data = fobj.read(min(COPY_CHUNKSIZE, count))
+        if not data:
+            break
+        wfile.write(data)
+        count -= len(data)
+
+
+class GzipCache(object):
+    """
+    Thread safe, in memory cache of gzipped file contents, holding at most
+    `max_size` MB and evicting the least recently used files first. Entries
+    are keyed by path, mtime and size, so changed files are compressed again.
+    """
+    def __init__(self, max_size=GZIP_CACHE_SIZE):
+        self.max_size = max_size * 1024 * 1024
+        self.entries = {}
+        self.size = 0
+        self.clock = 0
+        self.lock = threading.Lock()
+
+    def get(self, filepath, stat):
+        """
+        Return the gzipped contents of the file at `filepath`, which has the
+        os.stat result `stat`.
+        """
+        key = (filepath, stat.st_mtime, stat.st_size)
+        with self.lock:
+            self.clock += 1
+            if key in self.entries:
+                data, _ = self.entries[key]
+                self.entries[key] = (data, self.clock)
+                return data
+        buf = StringIO()
+        # mtime=0 keeps the output (and thus the ETag) stable
+        gzfile = gzip.GzipFile('', 'wb', GZIP_LEVEL, buf, mtime=0)
+        try:
+            with open(filepath, 'rb') as fobj:
+                gzfile.write(fobj.read())
+        finally:
+            gzfile.close()
+        data = buf.getvalue()
+        if len(data) > self.max_size:
+            return data
+        with self.lock:
+            # drop older versions of the same file
+            for old in [old for old in self.entries if old[0] == filepath]:
+                self.size -= len(self.entries.pop(old)[0])
+            self.entries[key] = (data, self.clock)
+            self.size += len(data)
+            lru = sorted(self.entries.items(), key=lambda item: item[1][1])
+            while self.size > self.max_size:
+                old, (olddata, _) = lru.pop(0)
+                del self.entries[old]
+                self.size -= len(olddata)
+        return data
@@ -0,0 +1,277 @@
+# -*- coding: utf-8 -*-
+from __future__ import with_statement
+from djeese.contentcache import prune_directory
+from email.utils import parsedate_tz, mktime_tz
+from requests.structures import CaseInsensitiveDict
+import hashlib
+import os
+import threading
+try:
+    import json
+except ImportError:
+    import simplejson as json
+
+DEFAULT_CACHE_SIZE = 64
+DISK_CACHE_MAX_SIZE = 256 * 1024 * 1024
+# status codes which may be cached without explicit freshness information
+CACHEABLE_STATUS = [200, 203, 300, 301, 410]
+# upper bound for the heuristic lifetime of responses without one, in seconds
+HEURISTIC_MAX_LIFETIME = 24 * 60 * 60
+# headers of a cached response updated by a 304 response
+UPDATABLE_HEADERS = ['cache-control', 'date', 'etag', 'expires', 'last-modified', 'vary']
+
+
+def parse_cache_control(value):
+    """
+    Parse a Cache-Control header into a dictionary mapping the (lowercased)
+    directives to their value, or None if they have none.
+    """
+    directives = {}
+    for part in (value or '').split(','):
+        part = part.strip()
+        if not part:
+            continue
+        if '=' in part:
+            name, argument = part.split('=', 1)
+            directives[name.strip().lower()] = argument.strip().strip('"')
+        else:
+            directives[part.lower()] = None
+    return directives
+
+def parse_http_date(value):
+    """
+    Parse an HTTP date into a timestamp. Returns None if `value` is missing or
+    invalid.
+    """
+    if not value:
+        return None
+    parsed = parsedate_tz(value)
+    if parsed is None:
+        return None
+    try:
+        return mktime_tz(parsed)
+    except (OverflowError, ValueError):
+        return None
+
+def get_lifetime(headers, now):
+    """
+    Return the number of seconds a response with `headers` stays fresh,
+    following the Cache-Control and Expires headers or, if there are none, 10%
+    of the time since it was last modified.
+    """
+    directives = parse_cache_control(headers.get('cache-control'))
+    if 'no-cache' in directives:
+        return 0
+    for name in ('s-maxage', 'max-age'):
+        if name in directives:
+            try:
+                return max(0, int(directives[name]))
+            except (TypeError, ValueError):
+                return 0
+    date = parse_http_date(headers.get('date')) or now
+    if 'expires' in headers:
+        expires = parse_http_date(headers['expires'])
+        if expires is None:
+            # invalid dates mean "already expired"
+            return 0
+        return max(0, expires - date)
+    last_modified = parse_http_date(headers.get('last-modified'))
+    if last_modified is not None:
+        return min(max(0, (date - last_modified) / 10), HEURISTIC_MAX_LIFETIME)
+    return 0
+
+def is_storable(status, headers):
+    """
+    Check whether a response to a GET request may be stored.
+    """
+    if status not in CACHEABLE_STATUS:
+        return False
+    if 'no-store' in parse_cache_control(headers.get('cache-control')):
+        return False
+    # cookies are meant for a single response
+    if 'set-cookie' in headers:
+        return False
+    # the cache key only includes the Accept-Encoding request header
+    vary = [name.strip().lower() for name in headers.get('vary', '').split(',') if name.strip()]
+    if [name for name in vary if name != 'accept-encoding']:
+        return False
+    return True
+
+
+class CacheEntry(object):
+    """
+    A cached response. `body` is the undecoded body as sent by the remote
+    site.
+    """
+    def __init__(self, status, headers, body, stored, lifetime):
+        self.status = status
+        self.headers = CaseInsensitiveDict(headers)
+        self.body = body
+        self.stored = stored
+        self.lifetime = lifetime
+        self.last_used = 0
+
+    @property
+    def size(self):
+        return len(self.body)
+
+    def is_fresh(self, now):
+        return now - self.stored < self.lifetime
+
+    def get_validators(self):
+        """
+        Return the headers to revalidate this entry with a conditional request.
+        """
+        validators = {}
+        if 'etag' in self.headers:
+            validators['If-None-Match'] = self.headers['etag']
+        if 'last-modified' in self.headers:
+            validators['If-Modified-Since'] = self.headers['last-modified']
+        return validators
+
+    def refresh(self, headers, now):
+        """
+        Update the entry with the headers of a 304 response.
+        """
+        for name in UPDATABLE_HEADERS:
+            if name in headers:
+                self.headers[name] = headers[name]
+        self.stored = now
+        self.lifetime = get_lifetime(self.headers, now)
+
+    def to_json(self):
+        return {
+            'status': self.status,
+            'headers': dict(self.headers.items()),
+            'stored': self.stored,
+            'lifetime': self.lifetime,
+        }
+
+
+class ResponseCache(object):
+    """
+    Thread safe, in memory cache of responses to GET requests, holding at most
+    `max_size` MB of response bodies and evicting the least recently used
+    responses first.
+
+    If `directory` is given, responses are also written to that directory and
+    read from it if they are not in memory (anymore), so they survive
+    evictions and restarts. The directory is pruned to DISK_CACHE_MAX_SIZE
+    bytes when the cache is created.
+
+    Hits, revalidations and misses are counted in the attributes of the same
+    name.
+    """
+    def __init__(self, max_size=DEFAULT_CACHE_SIZE, directory=None):
+        self.max_size = max_size * 1024 * 1024
+        self.directory = directory
+        self.entries = {}
+        self.size = 0
+        self.clock = 0
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.revalidated = 0
+        self.misses = 0
+        if directory is not None:
+            prune_directory(directory, DISK_CACHE_MAX_SIZE)
+
+    def get_key(self, url, headers):
+        """
+        Return the cache key for a GET of `url` with the request `headers`.
+        Responses depend on the cookies sent, eg if the user is logged in.
+        """
+        return '%s\n%s\n%s' % (url, headers.get('accept-encoding', ''), headers.get('cookie', ''))
+
+    def get_path(self, key):
+        digest = hashlib.sha1(key).hexdigest()
+        return os.path.join(self.directory, digest[:2], digest)
+
+    def get(self, key):
+        """
+        Return the CacheEntry for `key` or None.
+        """
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                self.clock += 1
+                entry.last_used = self.clock
+                return entry
+        if self.directory is None:
+            return None
+        entry = self.load(key)
+        if entry is not None:
+            self.add(key, entry)
+        return entry
+
+    def set(self, key, entry):
+        """
+        Store `entry` under `key`, unless it is larger than the whole cache.
+        """
+        if entry.size > self.max_size:
+            return
+        self.add(key, entry)
+        if self.directory is not None:
+            self.save(key, entry)
+
+    def add(self, key, entry):
+        with self.lock:
+            old = self.entries.pop(key, None)
+            if old is not None:
+                self.size -= old.size
+            self.clock += 1
+            entry.last_used = self.clock
+            self.entries[key] = entry
+            self.size += entry.size
+            if self.size > self.max_size:
+                self.evict()
+
+    def evict(self):
+        """
+        Drop the least recently used entries until the cache fits max_size.
+        Must be called with the lock held.
+        """
+        lru = sorted(self.entries.items(), key=lambda item: item[1].last_used)
+        while lru and self.size > self.max_size:
+            key, entry = lru.pop(0)
+            del self.entries[key]
+            self.size -= entry.size
+
+    def load(self, key):
+        path = self.get_path(key)
+        try:
+            with open('%s.json' % path) as fobj:
+                data = json.load(fobj)
+            with open('%s.body' % path, 'rb') as fobj:
+                body = fobj.read()
+        except (IOError, ValueError):
+            return None
+        return CacheEntry(data['status'], data['headers'], body, data['stored'], data['lifetime'])
+
+    def save(self, key, entry):
+        path = self.get_path(key)
+        dirname = os.path.dirname(path)
+        if not os.path.exists(dirname):
+            try:
+                os.makedirs(dirname)
+            except OSError:
+                # created by another thread in the meantime
+                if not os.path.isdir(dirname):
+                    raise
+        suffix = '%s.%s.tmp' % (os.getpid(), threading.currentThread().ident)
+        for extension, data in (('body', entry.body), ('json', json.dumps(entry.to_json()))):
+            target = '%s.%s' % (path, extension)
+            tmppath = '%s.%s' % (target, suffix)
+            with open(tmppath, 'wb') as fobj:
+                fobj.write(data)
+            os.rename(tmppath, target)
+
+    def count(self, outcome):
+        """
+        Count a 'hits', 'revalidated' or 'misses' outcome.
+        """
+        with self.lock:
+            setattr(self, outcome, getattr(self, outcome) + 1)
+
+    def get_stats(self):
+        return "%s hits, %s revalidated, %s misses, %.1f MB in memory" % (
+            self.hits, self.revalidated, self.misses, self.size / (1024.0 * 1024.0))
@@ -3,7 +3,6 @@ from __future__ import with_statement
 import getpass
 import os
 import re
-import requests
 
 class BaseValidator(object):
     """
@@ -36,7 +35,9 @@ class URLValidator(BaseValidator):
     message = "Could not open %r."
     
     def check(self, value):
-        return requests.get(value, timeout=5).status_code == 200
+        # imported here, it pulls in requests
+        from djeese.urlcheck import check_url
+        return check_url(value)
 
 
 class RegexValidator(BaseValidator):
@@ -0,0 +1,125 @@
+# -*- coding: utf-8 -*-
+from __future__ import with_statement
+import Queue
+import re
+import threading
+import zlib
+
+LIVERELOAD_PATH = '/__djeese__/livereload'
+LIVERELOAD_SCRIPT_PATH = '/__djeese__/livereload.js'
+SCRIPT_TAG = '<script src="%s"></script>' % LIVERELOAD_SCRIPT_PATH
+# encodings of HTML pages the script can be injected into
+INJECTABLE_ENCODINGS = ['identity', 'gzip', 'deflate', 'x-gzip']
+# seconds between keep-alive comments on the event stream
+PING_INTERVAL = 10
+# seconds to wait for further changes before sending an event
+DEBOUNCE = 0.1
+
+# Hot swaps changed stylesheets from the static folder and reloads the page
+# for any other change.
+LIVERELOAD_SCRIPT = """(function () {
+    if (!window.EventSource) {
+        return;
+    }
+    var source = new EventSource('%(path)s');
+    function swap(link) {
+        var href = link.href.replace(/[?&]djeese-reload=\\d+$/, '');
+        link.href = href + (href.indexOf('?') === -1 ? '?' : '&') + 'djeese-reload=' + new Date().getTime();
+    }
+    source.addEventListener('css', function (event) {
+        var changed = JSON.parse(event.data);
+        var links = document.getElementsByTagName('link');
+        var stylesheets = [];
+        var swapped = false;
+        for (var i = 0; i < links.length; i++) {
+            if (links[i].rel === 'stylesheet' && links[i].href.indexOf('/static/') !== -1) {
+                stylesheets.push(links[i]);
+            }
+        }
+        for (i = 0; i < stylesheets.length; i++) {
+            var path = stylesheets[i].href.split('?')[0];
+            for (var j = 0; j < changed.length; j++) {
+                if (path.slice(-changed[j].length - 8) === '/static/' + changed[j]) {
+                    swap(stylesheets[i]);
+                    swapped = true;
+                }
+            }
+        }
+        // the changed file might be imported by another stylesheet
+        if (!swapped) {
+            for (i = 0; i < stylesheets.length; i++) {
+                swap(stylesheets[i]);
+            }
+        }
+    });
+    source.addEventListener('reload', function () {
+        window.location.reload();
+    });
+})();
+""" % {'path': LIVERELOAD_PATH}
+
+
+def get_event(changed):
+    """
+    Return the name and data of the event for the set of `changed` paths:
+    'css' with the paths if only stylesheets changed, 'reload' otherwise.
+    """
+    changed = sorted(changed)
+    if [path for path in changed if not path.endswith('.css')]:
+        return 'reload', changed
+    return 'css', changed
+
+def decode_body(body, encoding):
+    """
+    Decode a response `body` with the content-encoding `encoding`, which must
+    be one of INJECTABLE_ENCODINGS.
+    """
+    if encoding in ('gzip', 'x-gzip'):
+        return zlib.decompress(body, 16 + zlib.MAX_WBITS)
+    if encoding == 'deflate':
+        try:
+            return zlib.decompress(body)
+        except zlib.error:
+            # some servers send raw deflate data
+            return zlib.decompress(body, -zlib.MAX_WBITS)
+    return body
+
+def inject_script(html):
+    """
+    Insert the SCRIPT_TAG before the closing body tag of `html`, or append it
+    if there is none.
+    """
+    match = None
+    for match in re.finditer(r'</body\s*>', html, re.IGNORECASE):
+        pass
+    if match is None:
+        return html + SCRIPT_TAG
+    return '%s%s%s' % (html[:match.start()], SCRIPT_TAG, html[match.start():])
+
+
+class LiveReload(object):
+    """
+    Passes the paths changed in a StaticIndex on to the browsers connected to
+    the event stream. Register notify as a listener of the index.
+    """
+    def __init__(self):
+        self.clients = []
+        self.lock = threading.Lock()
+
+    def subscribe(self):
+        """
+        Return a queue receiving the sets of changed paths.
+        """
+        queue = Queue.Queue()
+        with self.lock:
+            self.clients.append(queue)
+        return queue
+
+    def unsubscribe(self, queue):
+        with self.lock:
+            self.clients.remove(queue)
+
+    def notify(self, changed):
+        with self.lock:
+            for queue in self.clients:
+                queue.put(changed)
@@ -0,0 +1,140 @@
+# -*- coding: utf-8 -*-
+from __future__ import with_statement
+from djeese.scanner import DEFAULT_WORKERS, scan_tree
+import hashlib
+import os
+import urlparse
+try:
+    import json
+except ImportError:
+    import simplejson as json
+
+MANIFEST_DIR = os.path.join(os.path.expanduser('~'), '.djeese-manifests')
+HASH_BLOCK_SIZE = 64 * 1024
+
+
+def hash_file(filepath):
+    """
+    Return the hex encoded SHA-256 hash of the file at `filepath`.
+    """
+    digest = hashlib.sha256()
+    with open(filepath, 'rb') as fobj:
+        while True:
+            block = fobj.read(HASH_BLOCK_SIZE)
+            if not block:
+                break
+            digest.update(block)
+    return digest.hexdigest()
+
+def build_manifest(sourcedir, file_filter, previous=None, workers=DEFAULT_WORKERS):
+    """
+    Build a manifest for all files in `sourcedir` for which `file_filter`
+    (called with the basename) returns True.
+
+    The manifest is a dictionary mapping paths relative to `sourcedir` (using
+    forward slashes) to dictionaries with the keys 'size', 'mtime' and 'hash'.
+
+    If a `previous` manifest is given, hashes of files whose size and mtime did
+    not change are reused instead of reading the file again. Files are stat'ed
+    and hashed by `workers` threads.
+    """
+    previous = previous or {}
+    def process(entry):
+        if not entry.isfile:
+            return None
+        stat = os.stat(entry.path)
+        info = {'size': stat.st_size, 'mtime': int(stat.st_mtime)}
+        old = previous.get(entry.relpath)
+        if old and old['size'] == info['size'] and old['mtime'] == info['mtime']:
+            info['hash'] = old['hash']
+        else:
+            info['hash'] = hash_file(entry.path)
+        return entry.relpath, info
+    results = scan_tree(sourcedir, file_filter, process, workers)
+    return dict([result for result in results if result is not None])
+
+def get_tree_fingerprint(sourcedir, file_filter, workers=DEFAULT_WORKERS):
+    """
+    Return a hash of the paths, sizes and mtimes of the files in `sourcedir`
+    for which `file_filter` returns True, which changes when any of them is
+    added, removed or modified. Cheaper than build_manifest, since no file is
+    read.
+    """
+    def process(entry):
+        if not entry.isfile:
+            return None
+        stat = os.stat(entry.path)
+        return '%s\0%s\0%s' % (entry.relpath, stat.st_size, int(stat.st_mtime))
+    digest = hashlib.sha256()
+    for result in scan_tree(sourcedir, file_filter, process, workers):
+        if result is not None:
+            digest.update('%s\n' % result)
+    return digest.hexdigest()
+
+def diff_manifests(old, new):
+    """
+    Compare two manifests and return a tuple of (changed, deleted), where
+    `changed` is a sorted list of paths in `new` that are not in `old` or
+    have a different hash and `deleted` a sorted list of paths in `old` that
+    are no longer in `new`.
+
+    `old` may also be a plain dictionary mapping paths to hashes, as returned
+    by the server.
+    """
+    changed = []
+    for path, entry in new.items():
+        old_entry = old.get(path)
+        if isinstance(old_entry, dict):
+            old_entry = old_entry.get('hash')
+        if old_entry != entry['hash']:
+            changed.append(path)
+    deleted = [path for path in old if path not in new]
+    return sorted(changed), sorted(deleted)
+
+def normalize_manifest(data):
+    """
+    Turn a manifest as returned by the server, which maps paths either to
+    hashes or to dictionaries with at least a 'hash' key, into the format
+    returned by build_manifest.
+    """
+    manifest = {}
+    for path, entry in data.items():
+        if not isinstance(entry, dict):
+            entry = {'hash': entry}
+        manifest[path] = entry
+    return manifest
+
+def get_manifest_path(host, website):
+    """
+    Return the path of the local manifest of the last successful push of
+    `website` to `host`.
+    """
+    netloc = urlparse.urlsplit(host)[1].replace(':', '_')
+    return os.path.join(MANIFEST_DIR, netloc, '%s.json' % website)
+
+def load_manifest(host, website):
+    """
+    Load the local manifest for `website` on `host`. Returns an empty
+    dictionary if there is none or it can't be read.
+    """
+    path = get_manifest_path(host, website)
+    if not os.path.exists(path):
+        return {}
+    try:
+        with open(path) as fobj:
+            return json.load(fobj)
+    except (IOError, ValueError):
+        return {}
+
+def save_manifest(host, website, manifest):
+    """
+    Store `manifest` as the local manifest for `website` on `host`.
+    """
+    path = get_manifest_path(host, website)
+    dirname = os.path.dirname(path)
+    if not os.path.exists(dirname):
+        os.makedirs(dirname)
+    tmppath = '%s.tmp' % path
+    with open(tmppath, 'w') as fobj:
+        json.dump(manifest, fobj)
+    os.rename(tmppath, path)
@@ -47,4 +47,25 @@ class Printer(object):
     
     def log_only(self, message):
         self._print(4, message)
-    
\ No newline at end of file
+    
+
+class BufferedPrinter(Printer):
+    """
+    Printer collecting the messages to print in `lines` instead of printing
+    them, so output of parallel jobs does not interleave. Errors and warnings
+    are also collected in `errors` and `warnings`, whatever the verbosity.
+    """
+    def __init__(self, verbosity, logfile=None):
+        super(BufferedPrinter, self).__init__(verbosity, logfile)
+        self.lines = []
+        self.errors = []
+        self.warnings = []
+
+    def _print(self, level, message):
+        self.logfile.write('[%s]%s\n' % (LEVELS[level], message))
+        if level == 1:
+            self.errors.append(message)
+        elif level == 2:
+            self.warnings.append(message)
+        if self.verbosity >= level:
+            self.lines.append(message)
@@ -0,0 +1,92 @@
+# -*- coding: utf-8 -*-
+from multiprocessing.pool import ThreadPool
+import os
+import stat
+try:
+    from os import scandir
+except ImportError:
+    try:
+        from scandir import scandir
+    except ImportError: # scandir is optional
+        scandir = None
+
+DEFAULT_WORKERS = 8
+SCAN_CHUNKSIZE = 64
+
+
+class ScanEntry(object):
+    """
+    A file or directory found while scanning a tree. `relpath` is relative to
+    the scanned directory and always uses forward slashes.
+    """
+    def __init__(self, path, relpath, isdir, isfile):
+        self.path = path
+        self.relpath = relpath
+        self.isdir = isdir
+        self.isfile = isfile
+
+
+def _listdir(path):
+    """
+    Return a list of (name, isdir, isfile) tuples for the entries in `path`,
+    not following symlinks.
+    """
+    if scandir is not None:
+        return [(entry.name, entry.is_dir(follow_symlinks=False),
+                 entry.is_file(follow_symlinks=False)) for entry in scandir(path)]
+    entries = []
+    for name in os.listdir(path):
+        # a single lstat instead of islink, isdir and isfile
+        mode = os.lstat(os.path.join(path, name)).st_mode
+        entries.append((name, stat.S_ISDIR(mode), stat.S_ISREG(mode)))
+    return entries
+
+def _walk(path, relpath, file_filter):
+    for name, isdir, isfile in sorted(_listdir(path)):
+        fullpath = os.path.join(path, name)
+        childrelpath = '%s/%s' % (relpath, name) if relpath else name
+        if isfile and not file_filter(name):
+            continue
+        yield ScanEntry(fullpath, childrelpath, isdir, isfile)
+        if isdir:
+            for entry in _walk(fullpath, childrelpath, file_filter):
+                yield entry
+
+def iter_entries(top, file_filter):
+    """
+    Walk `top` depth first, in sorted order, and yield a ScanEntry for `top`
+    itself, every directory and every regular file for which `file_filter`
+    (called with the basename) returns True. Other files (eg symlinks) are not
+    filtered.
+    """
+    yield ScanEntry(top, '', True, False)
+    for entry in _walk(top, '', file_filter):
+        yield entry
+
+def scan_tree(top, file_filter, process, workers=DEFAULT_WORKERS):
+    """
+    Call `process` with every ScanEntry from iter_entries(top, file_filter)
+    and yield the results in walk order.
+
+    `process` is called concurrently by `workers` threads, so stat calls and
+    hashing of different files overlap. If `workers` is 1 or less, everything
+    happens in the calling thread.
+
+    The tree is always walked in the calling thread, so errors listing a
+    directory are raised from here instead of ending the scan early.
+    """
+    if workers <= 1:
+        for entry in iter_entries(top, file_filter):
+            yield process(entry)
+        return
+    # the pool swallows exceptions raised by the iterable it consumes
+    entries = list(iter_entries(top, file_filter))
+    pool = ThreadPool(workers)
+    try:
+        for result in pool.imap(process, entries, SCAN_CHUNKSIZE):
+            yield result
+    except:
+        pool.terminate()
+        raise
+    pool.close()
+    pool.join()
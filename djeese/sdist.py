@@ -0,0 +1,255 @@
+# -*- coding: utf-8 -*-
+from __future__ import with_statement
+import distutils.core
+import hashlib
+import os
+import shutil
+import subprocess
+import sys
+import tarfile
+try:
+    import json
+except ImportError:
+    import simplejson as json
+
+SDIST_CACHE_DIR = os.path.join(os.path.expanduser('~'), '.djeese-sdists')
+SDIST_ARGS = ['sdist', '--formats=gztar', '-d']
+# always part of the sources, even if the sdist does not include them
+SETUP_FILES = ['setup.py', 'setup.cfg', 'MANIFEST.in']
+# entries of source directories which don't affect the sdist
+IGNORED_SUFFIXES = ('.pyc', '.pyo', '.log', '.egg-info', '.tmp', '~')
+IGNORED_NAMES = ['build', 'dist']
+
+
+def _run_setup(setuppy, args):
+    """
+    Run the setup.py at `setuppy` with `args` in this process, from its
+    directory and with its output discarded.
+    """
+    setuppy = os.path.abspath(setuppy)
+    setupdir = os.path.dirname(setuppy)
+    saved = os.getcwd(), sys.argv, sys.path[:], sys.stdout, sys.stderr
+    modules = set(sys.modules)
+    fnull = open(os.devnull, 'w')
+    try:
+        os.chdir(setupdir)
+        sys.argv = [setuppy] + args
+        sys.path.insert(0, setupdir)
+        sys.stdout = sys.stderr = fnull
+        distutils.core._setup_stop_after = None
+        namespace = {'__file__': setuppy, '__name__': '__main__'}
+        with open(setuppy) as fobj:
+            code = compile(fobj.read(), setuppy, 'exec')
+        exec code in namespace
+    finally:
+        cwd, sys.argv, sys.path, sys.stdout, sys.stderr = saved
+        os.chdir(cwd)
+        fnull.close()
+        # forget modules of the package imported by the setup.py (usually to
+        # get its version), another app may have one of the same name
+        for name in set(sys.modules) - modules:
+            module = sys.modules[name]
+            filename = getattr(module, '__file__', None)
+            if filename and os.path.abspath(filename).startswith(setupdir + os.sep):
+                del sys.modules[name]
+
+def build_sdist(setuppy, outputdir):
+    """
+    Build a source distribution of the setup.py at `setuppy` into the empty
+    directory `outputdir` and return its path.
+
+    The setup.py is run in this process, which saves starting an interpreter.
+    If that fails, it is run with the same Python as this process.
+    """
+    outputdir = os.path.abspath(outputdir)
+    try:
+        _run_setup(setuppy, SDIST_ARGS + [outputdir])
+    except (Exception, SystemExit):
+        # some setup.py files only work as scripts
+        shutil.rmtree(outputdir)
+        os.makedirs(outputdir)
+    if not os.listdir(outputdir):
+        fnull = open(os.devnull, 'w')
+        try:
+            subprocess.check_call([sys.executable, os.path.abspath(setuppy)] + SDIST_ARGS + [outputdir],
+                                  stdout=fnull, stderr=fnull, cwd=os.path.dirname(os.path.abspath(setuppy)))
+        finally:
+            fnull.close()
+    return os.path.join(outputdir, os.listdir(outputdir)[0])
+
+def get_sdist_sources(sdistpath):
+    """
+    Return the paths of the files in the sdist at `sdistpath`, relative to
+    the directory of the setup.py. Metadata generated by the sdist command
+    is left out.
+    """
+    tarball = tarfile.open(sdistpath)
+    try:
+        names = [member.name for member in tarball.getmembers() if member.isfile()]
+    finally:
+        tarball.close()
+    sources = []
+    for name in names:
+        # strip the name-version/ prefix
+        relpath = name.partition('/')[2]
+        if not relpath or relpath == 'PKG-INFO' or relpath.split('/')[0].endswith('.egg-info'):
+            continue
+        sources.append(relpath)
+    return sources
+
+def _read(path, size=-1):
+    try:
+        with open(path, 'rb') as fobj:
+            return fobj.read(size)
+    except IOError:
+        return ''
+
+def _get_git_state(gitdir):
+    """
+    Return the checked out commit and the tags of the git repository at
+    `gitdir` (a .git directory or file) as a string.
+    """
+    if os.path.isfile(gitdir):
+        # worktrees and submodules point to their git directory
+        gitdir = os.path.join(os.path.dirname(gitdir), _read(gitdir).strip().partition('gitdir:')[2].strip())
+    commondir = _read(os.path.join(gitdir, 'commondir')).strip()
+    commondir = os.path.join(gitdir, commondir) if commondir else gitdir
+    head = _read(os.path.join(gitdir, 'HEAD'))
+    state = [head]
+    if head.startswith('ref:'):
+        state.append(_read(os.path.join(commondir, head[4:].strip())))
+    state.append(_read(os.path.join(commondir, 'packed-refs')))
+    tagsdir = os.path.join(commondir, 'refs', 'tags')
+    for dirpath, dirnames, filenames in os.walk(tagsdir):
+        dirnames.sort()
+        for filename in sorted(filenames):
+            path = os.path.join(dirpath, filename)
+            state.append('%s %s' % (os.path.relpath(path, tagsdir), _read(path)))
+    return '\0'.join(state)
+
+def get_vcs_state(setupdir):
+    """
+    Return a string describing the version control state of the repository
+    containing `setupdir`, or an empty string if it is not in one. Packages
+    taking their version from the repository (eg setuptools_scm) get a new
+    version when this changes, even if none of their files do.
+    """
+    directory = os.path.abspath(setupdir)
+    while True:
+        gitdir = os.path.join(directory, '.git')
+        if os.path.exists(gitdir):
+            return 'git\0%s' % _get_git_state(gitdir)
+        hgdir = os.path.join(directory, '.hg')
+        if os.path.isdir(hgdir):
+            # the dirstate starts with the working directory's parents
+            return 'hg\0%s\0%s' % (_read(os.path.join(hgdir, 'dirstate'), 40),
+                                   _read(os.path.join(hgdir, 'localtags')))
+        parent = os.path.dirname(directory)
+        if parent == directory:
+            return ''
+        directory = parent
+
+def get_sources_digest(setupdir, sources):
+    """
+    Return a hash of the contents of the `sources` (paths relative to
+    `setupdir`) and of the listings of the directories they are in, so files
+    added next to them change the hash too. The version control state is
+    included as well, see get_vcs_state.
+    """
+    digest = hashlib.sha256()
+    digest.update('%s\0' % get_vcs_state(setupdir))
+    directories = set([''])
+    for relpath in sorted(set(sources + SETUP_FILES)):
+        path = os.path.join(setupdir, relpath)
+        digest.update('%s\0' % relpath)
+        if os.path.isfile(path):
+            with open(path, 'rb') as fobj:
+                digest.update(hashlib.sha256(fobj.read()).hexdigest())
+        else:
+            digest.update('-')
+        directories.add(os.path.dirname(relpath))
+    for directory in sorted(directories):
+        try:
+            names = os.listdir(os.path.join(setupdir, directory))
+        except OSError:
+            names = []
+        names = [name for name in names if not (name.startswith('.') or
+                 name.endswith(IGNORED_SUFFIXES) or name in IGNORED_NAMES)]
+        digest.update('%s\0%s\0' % (directory, '\0'.join(sorted(names))))
+    return digest.hexdigest()
+
+
+class SdistCache(object):
+    """
+    Keeps the last source distribution built for each setup.py, together with
+    a hash of its sources, so it can be reused as long as they don't change.
+    """
+    def __init__(self, root=SDIST_CACHE_DIR):
+        self.root = root
+
+    def get_dir(self, setuppy):
+        return os.path.join(self.root, hashlib.sha1(os.path.abspath(setuppy)).hexdigest())
+
+    def load(self, setuppy):
+        try:
+            with open(os.path.join(self.get_dir(setuppy), 'sources.json')) as fobj:
+                return json.load(fobj)
+        except (IOError, ValueError):
+            return None
+
+    def get(self, setuppy):
+        """
+        Return the path of the cached sdist for `setuppy` or None if there is
+        none or its sources changed.
+        """
+        cachedir = self.get_dir(setuppy)
+        data = self.load(setuppy)
+        if data is None:
+            return None
+        sdistpath = os.path.join(cachedir, data['sdist'])
+        if not os.path.exists(sdistpath):
+            return None
+        setupdir = os.path.dirname(os.path.abspath(setuppy))
+        if get_sources_digest(setupdir, data['sources']) != data['digest']:
+            return None
+        return sdistpath
+
+    def set(self, setuppy, sdistpath):
+        """
+        Store the sdist at `sdistpath` built from `setuppy`, replacing the
+        previous one.
+        """
+        cachedir = self.get_dir(setuppy)
+        if os.path.exists(cachedir):
+            shutil.rmtree(cachedir)
+        os.makedirs(cachedir)
+        sources = get_sdist_sources(sdistpath)
+        setupdir = os.path.dirname(os.path.abspath(setuppy))
+        data = {
+            'sdist': os.path.basename(sdistpath),
+            'sources': sources,
+            'digest': get_sources_digest(setupdir, sources),
+        }
+        shutil.copy(sdistpath, os.path.join(cachedir, data['sdist']))
+        with open(os.path.join(cachedir, 'sources.json'), 'w') as fobj:
+            json.dump(data, fobj)
+
+    def get_digest(self, setuppy):
+        """
+        Return a hash of the current sources of `setuppy`, as far as they are
+        known from the last build (otherwise only the setup files count).
+        """
+        data = self.load(setuppy) or {'sources': []}
+        return get_sources_digest(os.path.dirname(os.path.abspath(setuppy)), data['sources'])
+
+    def build(self, setuppy, outputdir):
+        """
+        Return the path of the cached sdist for `setuppy`, or build it into
+        `outputdir` and cache it.
+        """
+        sdistpath = self.get(setuppy)
+        if sdistpath is not None:
+            return sdistpath
+        sdistpath = build_sdist(setuppy, outputdir)
+        self.set(setuppy, sdistpath)
+        return sdistpath
@@ -0,0 +1,80 @@
+# -*- coding: utf-8 -*-
+from __future__ import with_statement
+import os
+import time
+try:
+    import json
+except ImportError:
+    import simplejson as json
+
+SESSIONS_FILE = os.path.join(os.path.expanduser('~'), '.djeese-sessions')
+# lifetime of sessions whose cookies don't say when they expire
+SESSION_TTL = 12 * 60 * 60
+
+
+def load_sessions():
+    """
+    Load all stored sessions, a dictionary mapping hosts to their cookies and
+    expiry time. Returns an empty dictionary if there are none or they can't
+    be read.
+    """
+    if not os.path.exists(SESSIONS_FILE):
+        return {}
+    try:
+        with open(SESSIONS_FILE) as fobj:
+            return json.load(fobj)
+    except (IOError, ValueError):
+        return {}
+
+def write_sessions(sessions):
+    # the cookies are as good as a password, so only the user may read them
+    tmppath = '%s.%s.tmp' % (SESSIONS_FILE, os.getpid())
+    fd = os.open(tmppath, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0600)
+    with os.fdopen(fd, 'w') as fobj:
+        json.dump(sessions, fobj)
+    os.rename(tmppath, SESSIONS_FILE)
+
+def load_session(host):
+    """
+    Return the stored cookies of the session on `host` as a list of
+    dictionaries, or None if there is none or it expired.
+    """
+    session = load_sessions().get(host)
+    if session is None or session['expires'] <= time.time():
+        return None
+    return session['cookies']
+
+def save_session(host, cookiejar):
+    """
+    Store the cookies in `cookiejar` as the session on `host`. The session
+    expires with the first of its cookies to expire, or after SESSION_TTL
+    seconds if none of them does.
+    """
+    now = time.time()
+    cookies = []
+    for cookie in cookiejar:
+        if cookie.is_expired(now):
+            continue
+        cookies.append({
+            'name': cookie.name,
+            'value': cookie.value,
+            'domain': cookie.domain,
+            'path': cookie.path,
+            'secure': cookie.secure,
+            'expires': cookie.expires,
+        })
+    expires = [cookie['expires'] for cookie in cookies if cookie['expires']]
+    sessions = load_sessions()
+    sessions[host] = {
+        'cookies': cookies,
+        'expires': min(expires) if expires else now + SESSION_TTL,
+    }
+    write_sessions(sessions)
+
+def discard_session(host):
+    """
+    Forget the session on `host`.
+    """
+    sessions = load_sessions()
+    if sessions.pop(host, None) is not None:
+        write_sessions(sessions)
@@ -0,0 +1,225 @@
+# -*- coding: utf-8 -*-
+from __future__ import with_statement
+from djeese.scanner import iter_entries
+import os
+import threading
+import time
+try:
+    import pyinotify
+except ImportError: # pyinotify is optional
+    pyinotify = None
+
+POLL_INTERVAL = 1.0
+
+
+def is_safe_path(relpath):
+    """
+    Check whether the URL path `relpath` stays inside the directory it is
+    relative to.
+    """
+    if relpath.startswith('/') or '\\' in relpath or '\0' in relpath:
+        return False
+    return '..' not in relpath.split('/')
+
+
+class IndexEntry(object):
+    """
+    A file in the index. Has the same st_size and st_mtime attributes as an
+    os.stat result. `ctype` is set by the request handler the first time the
+    file is served.
+    """
+    def __init__(self, path, relpath, stat):
+        self.path = path
+        self.relpath = relpath
+        self.st_size = stat.st_size
+        self.st_mtime = stat.st_mtime
+        self.ctype = None
+
+
+class StaticIndex(object):
+    """
+    In memory index of the files in `root`, so looking up whether a file
+    exists, its size and its mtime does not touch the disk.
+
+    Once started, the index is kept up to date with inotify if pyinotify is
+    installed, otherwise by rescanning `root` every `poll_interval` seconds.
+    Callables in `listeners` are called with the set of changed relative paths
+    whenever files are added, changed or removed. Errors while watching are
+    reported to `printer`, if given.
+
+    Links to directories inside `root` are followed, links to directories
+    outside of it only if `follow_symlinks` is set.
+    """
+    def __init__(self, root, poll_interval=POLL_INTERVAL, printer=None,
+                 follow_symlinks=False):
+        self.root = root
+        self.poll_interval = poll_interval
+        self.printer = printer
+        self.follow_symlinks = follow_symlinks
+        # linked directories followed by the last scan
+        self.linked = set()
+        # called with the linked directories after a scan, to watch them
+        self.watch_links = None
+        self.entries = {}
+        self.listeners = []
+        self.lock = threading.Lock()
+        # set when an update failed, the next one rescans everything
+        self.stale = False
+        self.scan()
+
+    def lookup(self, relpath):
+        """
+        Return the IndexEntry for the file at the URL path `relpath` (relative
+        to root) or None.
+        """
+        return self.entries.get(relpath)
+
+    def make_entry(self, path, relpath):
+        """
+        Return an IndexEntry for the file at `path`, or None if it isn't a
+        (link to a) regular file (anymore).
+        """
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return None
+        if not os.path.isfile(path):
+            return None
+        return IndexEntry(path, relpath, stat)
+
+    def iter_files(self):
+        """
+        Yield a tuple of (path, relpath) for everything under root which is
+        not a directory, following links to directories as described in the
+        class docstring. Each linked directory is followed only once, which
+        also ends loops.
+        """
+        realroot = os.path.realpath(self.root)
+        visited = set([realroot])
+        pending = [(self.root, '')]
+        linked = set()
+        while pending:
+            top, prefix = pending.pop(0)
+            for scanentry in iter_entries(top, lambda name: True):
+                if scanentry.isdir:
+                    continue
+                relpath = prefix + scanentry.relpath
+                if not scanentry.isfile and os.path.isdir(scanentry.path):
+                    realpath = os.path.realpath(scanentry.path)
+                    inside = realpath.startswith(realroot + os.sep)
+                    if realpath not in visited and (inside or self.follow_symlinks):
+                        visited.add(realpath)
+                        pending.append((scanentry.path, relpath + '/'))
+                        linked.add(scanentry.path)
+                    continue
+                yield scanentry.path, relpath
+        self.linked = linked
+
+    def scan(self):
+        """
+        Rebuild the index from the disk.
+        """
+        entries = {}
+        for path, relpath in self.iter_files():
+            entry = self.make_entry(path, relpath)
+            if entry is not None:
+                entries[entry.relpath] = entry
+        with self.lock:
+            old, self.entries = self.entries, entries
+        if self.watch_links is not None:
+            self.watch_links(self.linked)
+        changed = set(relpath for relpath in old if relpath not in entries)
+        for relpath, entry in entries.items():
+            oldentry = old.get(relpath)
+            if oldentry is None or (oldentry.st_size, oldentry.st_mtime) != (entry.st_size, entry.st_mtime):
+                changed.add(relpath)
+        self.notify(changed)
+
+    def update(self, path):
+        """
+        Update the index for the (possibly removed) file or directory at
+        `path`.
+        """
+        relpath = os.path.relpath(path, self.root).replace(os.sep, '/')
+        if os.path.isdir(path) or self.linked:
+            # files may have been created before the directory was watched,
+            # and changes below linked directories are reported for one of
+            # the paths leading to them only
+            return self.scan()
+        entry = self.make_entry(path, relpath)
+        with self.lock:
+            entries = dict(self.entries)
+            if entry is None:
+                prefix = relpath + '/'
+                changed = set(name for name in entries if name == relpath or name.startswith(prefix))
+                for name in changed:
+                    del entries[name]
+            else:
+                old = entries.get(relpath)
+                changed = set()
+                if old is None or (old.st_size, old.st_mtime) != (entry.st_size, entry.st_mtime):
+                    changed.add(relpath)
+                entries[relpath] = entry
+            self.entries = entries
+        self.notify(changed)
+
+    def refresh(self, path=None):
+        """
+        Update the index for `path`, or rescan root if `path` is None or the
+        last refresh failed. Called by the watcher threads, so errors (eg a
+        directory removed while it was scanned) are reported instead of
+        raised, and the next refresh tries again.
+        """
+        try:
+            if path is None or self.stale:
+                self.stale = False
+                self.scan()
+            else:
+                self.update(path)
+        except OSError, e:
+            self.stale = True
+            if self.printer is not None:
+                self.printer.warning("Updating the index of %r failed, trying again later: %s" % (self.root, e))
+
+    def notify(self, changed):
+        if changed:
+            for listener in self.listeners:
+                listener(changed)
+
+    def start(self):
+        """
+        Start watching root for changes in a daemon thread. Returns 'inotify'
+        or 'polling'.
+        """
+        if pyinotify is not None:
+            index = self
+            class EventHandler(pyinotify.ProcessEvent):
+                def process_default(self, event):
+                    index.refresh(event.pathname)
+            manager = pyinotify.WatchManager()
+            mask = (pyinotify.IN_CLOSE_WRITE | pyinotify.IN_CREATE | pyinotify.IN_DELETE |
+                    pyinotify.IN_MODIFY | pyinotify.IN_MOVED_FROM | pyinotify.IN_MOVED_TO |
+                    pyinotify.IN_ATTRIB)
+            notifier = pyinotify.ThreadedNotifier(manager, EventHandler())
+            notifier.daemon = True
+            notifier.start()
+            manager.add_watch(self.root, mask, rec=True, auto_add=True)
+            # inotify does not follow links, their targets are watched too
+            watched = set()
+            def watch_links(linked):
+                for path in linked - watched:
+                    manager.add_watch(path, mask, rec=True, auto_add=True)
+                    watched.add(path)
+            self.watch_links = watch_links
+            # catch changes made before the watches were in place
+            self.scan()
+            return 'inotify'
+        thread = threading.Thread(target=self.poll)
+        thread.daemon = True
+        thread.start()
+        return 'polling'
+
+    def poll(self):
+        while True:
+            time.sleep(self.poll_interval)
+            self.refresh()
@@ -0,0 +1,155 @@
+# -*- coding: utf-8 -*-
+import uuid
+
+FILE_CHUNKSIZE = 64 * 1024
+
+
+def iter_file(fobj, chunksize=FILE_CHUNKSIZE):
+    """
+    Iterate over the rest of the file `fobj` in chunks of `chunksize` bytes.
+    """
+    return iter(lambda: fobj.read(chunksize), '')
+
+
+class ChunkSink(object):
+    """
+    Write-only file like object collecting everything written to it until it
+    gets drained.
+    """
+    def __init__(self):
+        self.chunks = []
+
+    def write(self, data):
+        if data:
+            self.chunks.append(data)
+
+    def flush(self):
+        pass
+
+    def drain(self):
+        """
+        Return everything written since the last call and forget about it.
+        """
+        data = ''.join(self.chunks)
+        self.chunks = []
+        return data
+
+
+class MultipartStream(object):
+    """
+    A multipart/form-data request body that streams a single file from an
+    iterable of `chunks`. requests sends it using chunked transfer encoding.
+    """
+    def __init__(self, fields, filefield, filename, chunks):
+        self.boundary = uuid.uuid4().hex
+        self.chunks = chunks
+        head = []
+        for key, value in sorted(fields.items()):
+            head.append('--%s\r\n' % self.boundary)
+            head.append('Content-Disposition: form-data; name="%s"\r\n\r\n' % key)
+            head.append('%s\r\n' % value)
+        head.append('--%s\r\n' % self.boundary)
+        head.append('Content-Disposition: form-data; name="%s"; filename="%s"\r\n' % (filefield, filename))
+        head.append('Content-Type: application/octet-stream\r\n\r\n')
+        self.head = ''.join(head)
+        self.tail = '\r\n--%s--\r\n' % self.boundary
+
+    @property
+    def content_type(self):
+        return 'multipart/form-data; boundary=%s' % self.boundary
+
+    def __iter__(self):
+        yield self.head
+        for chunk in self.chunks:
+            if chunk:
+                yield chunk
+        yield self.tail
+
+
+class SizedMultipartStream(MultipartStream):
+    """
+    A MultipartStream where the total `length` of all chunks is known in
+    advance. It behaves like a file, so requests sends it with a
+    Content-Length header.
+    """
+    def __init__(self, fields, filefield, filename, chunks, length):
+        super(SizedMultipartStream, self).__init__(fields, filefield, filename, chunks)
+        self.length = length
+        self._iterator = None
+        self._buffer = ''
+
+    def __len__(self):
+        return len(self.head) + self.length + len(self.tail)
+
+    def read(self, size=-1):
+        if self._iterator is None:
+            self._iterator = iter(self)
+        while size < 0 or len(self._buffer) < size:
+            try:
+                self._buffer += self._iterator.next()
+            except StopIteration:
+                break
+        if size < 0:
+            size = len(self._buffer)
+        data, self._buffer = self._buffer[:size], self._buffer[size:]
+        return data
+
+
+class RequestBody(object):
+    """
+    File like object reading a request body of `length` bytes from `rfile`
+    without buffering it, so requests can stream it upstream with a
+    Content-Length header.
+    """
+    def __init__(self, rfile, length):
+        self.rfile = rfile
+        self.length = length
+        self.remaining = length
+
+    def __len__(self):
+        return self.length
+
+    @property
+    def exhausted(self):
+        return not self.remaining
+
+    def read(self, size=-1):
+        if size < 0 or size > self.remaining:
+            size = self.remaining
+        data = self.rfile.read(size) if size else ''
+        if size and not data:
+            raise IOError("Client closed the connection before sending the whole body")
+        self.remaining -= len(data)
+        return data
+
+
+class ChunkedRequestBody(object):
+    """
+    Iterable over the decoded chunks of a request body sent with chunked
+    transfer encoding from `rfile`, so requests can stream it upstream
+    chunked again.
+    """
+    def __init__(self, rfile):
+        self.rfile = rfile
+        self.exhausted = False
+
+    def __iter__(self):
+        while not self.exhausted:
+            line = self.rfile.readline()
+            if not line:
+                raise IOError("Client closed the connection before sending the whole body")
+            try:
+                size = int(line.split(';', 1)[0].strip(), 16)
+            except ValueError:
+                raise IOError("Invalid chunk size %r" % line.strip())
+            if size < 0:
+                raise IOError("Invalid chunk size %r" % line.strip())
+            if not size:
+                # skip the trailers
+                while self.rfile.readline() not in ('\r\n', '\n', ''):
+                    pass
+                self.exhausted = True
+                break
+            data = self.rfile.read(size)
+            self.rfile.readline()
+            yield data
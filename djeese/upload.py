@@ -0,0 +1,250 @@
+# -*- coding: utf-8 -*-
+from __future__ import with_statement
+from djeese.commands import CommandError
+from djeese.manifest import hash_file
+from multiprocessing.pool import ThreadPool
+from optparse import make_option
+import os
+import requests
+import shutil
+import threading
+import time
+import urlparse
+try:
+    import json
+except ImportError:
+    import simplejson as json
+
+UPLOADS_PATH = '/api/v1/io/uploads/'
+UPLOADS_DIR = os.path.join(os.path.expanduser('~'), '.djeese-uploads')
+DEFAULT_PART_SIZE = 8
+DEFAULT_UPLOAD_WORKERS = 4
+# responses to the commit call after which committing the same payload again
+# can't succeed, 403 only means the session has to log in again
+FINAL_STATUS = range(400, 403) + range(404, 500)
+RETRIES = 5
+BACKOFF = 1.0
+
+UPLOAD_OPTIONS = (
+    make_option('--resumable', action='store_true', dest='resumable', default=False,
+        help='Upload in parts which are retried on failure. Interrupted uploads are resumed on the next run.'
+    ),
+    make_option('--part-size', action='store', dest='part_size', default=DEFAULT_PART_SIZE,
+        type='int', help='Size of the parts of a resumable upload in MB.'
+    ),
+    make_option('--upload-workers', action='store', dest='upload_workers', default=DEFAULT_UPLOAD_WORKERS,
+        type='int', help='Number of parts of a resumable upload, or of apps when uploading several, sent concurrently.'
+    ),
+    make_option('--restart', action='store_true', dest='restart', default=False,
+        help='Discard an interrupted resumable upload instead of resuming it.'
+    ),
+)
+
+
+class UploadError(Exception):
+    """
+    Raised if a part of a resumable upload failed permanently. `response` is
+    the last response received, if any.
+    """
+    def __init__(self, message, response=None):
+        Exception.__init__(self, message)
+        self.response = response
+
+
+class ChunkedUploader(object):
+    """
+    Uploads a payload file in fixed size parts, `workers` at a time, retrying
+    failed parts with exponential backoff, then commits the upload.
+
+    The state of the upload is kept in a state file in UPLOADS_DIR, named
+    after `key`, together with a copy of the payload, so an interrupted upload
+    can be resumed by a later process.
+
+    Protocol:
+        POST   UPLOADS_PATH                  create, returns {"id": ...}
+        GET    UPLOADS_PATH<id>/             returns {"parts": [...]}
+        PUT    UPLOADS_PATH<id>/<index>/     upload a part
+        POST   UPLOADS_PATH<id>/commit/      finish, returns the response of
+                                             the equivalent single upload
+    """
+    def __init__(self, session, get_absolute_url, key, printer,
+                 part_size=DEFAULT_PART_SIZE, workers=DEFAULT_UPLOAD_WORKERS,
+                 retries=RETRIES, backoff=BACKOFF):
+        self.session = session
+        self.get_absolute_url = get_absolute_url
+        self.printer = printer
+        self.part_size = part_size * 1024 * 1024
+        self.workers = workers
+        self.retries = retries
+        self.backoff = backoff
+        netloc = urlparse.urlsplit(get_absolute_url('/'))[1].replace(':', '_')
+        basename = os.path.join(UPLOADS_DIR, netloc, key)
+        self.statefile = '%s.json' % basename
+        self.payload = '%s.payload' % basename
+        self.lock = threading.Lock()
+        self.state = None
+
+    def load_state(self):
+        """
+        Load the state of an interrupted upload. Returns None if there is
+        none.
+        """
+        if not (os.path.exists(self.statefile) and os.path.exists(self.payload)):
+            return None
+        try:
+            with open(self.statefile) as fobj:
+                return json.load(fobj)
+        except (IOError, ValueError):
+            return None
+
+    def save_state(self):
+        tmppath = '%s.tmp' % self.statefile
+        with open(tmppath, 'w') as fobj:
+            json.dump(self.state, fobj)
+        os.rename(tmppath, self.statefile)
+
+    def check_source(self, state, source):
+        """
+        Check whether the interrupted upload described by `state` was made
+        from `source` (a fingerprint of what the payload is built from). If
+        not, the payload is outdated and the upload is discarded.
+        """
+        if state.get('source') == source:
+            return True
+        self.printer.warning("The files changed since the upload was interrupted, starting over")
+        self.discard()
+        return False
+
+    def discard(self):
+        """
+        Forget about an interrupted upload.
+        """
+        for path in (self.statefile, self.payload):
+            if os.path.exists(path):
+                os.remove(path)
+        self.state = None
+
+    def store_payload(self, fileobj):
+        """
+        Copy the payload from `fileobj` into the uploads directory.
+        """
+        dirname = os.path.dirname(self.payload)
+        if not os.path.exists(dirname):
+            os.makedirs(dirname)
+        with open(self.payload, 'wb') as fobj:
+            shutil.copyfileobj(fileobj, fobj)
+
+    def start(self, fields, extra=None, source=None):
+        """
+        Register a new upload of the stored payload with the server. `fields`
+        are sent with the commit call, `extra` and `source` (see check_source)
+        are kept in the state for the caller.
+        """
+        size = os.path.getsize(self.payload)
+        parts = max(1, (size + self.part_size - 1) // self.part_size)
+        data = {
+            'size': size,
+            'parts': parts,
+            'part-size': self.part_size,
+            'hash': hash_file(self.payload),
+        }
+        response = self.session.post(self.get_absolute_url(UPLOADS_PATH), data=data)
+        if response.status_code not in (200, 201):
+            raise UploadError("Could not start upload", response)
+        try:
+            data['id'] = json.loads(response.content)['id']
+        except (ValueError, KeyError, TypeError):
+            raise CommandError("Could not start upload: invalid response from server")
+        data['fields'] = fields
+        data['extra'] = extra
+        data['source'] = source
+        data['done'] = []
+        self.state = data
+        self.save_state()
+
+    def upload_part(self, index):
+        """
+        Upload a single part, retrying with exponential backoff on connection
+        errors and server errors.
+        """
+        url = self.get_absolute_url('%s%s/%s/' % (UPLOADS_PATH, self.state['id'], index))
+        with open(self.payload, 'rb') as fobj:
+            fobj.seek(index * self.state['part-size'])
+            data = fobj.read(self.state['part-size'])
+        response = None
+        for attempt in range(self.retries):
+            if attempt:
+                delay = self.backoff * (2 ** (attempt - 1))
+                self.printer.info("Retrying part %s in %.1fs" % (index + 1, delay))
+                time.sleep(delay)
+            try:
+                response = self.session.put(url, data=data)
+            except requests.RequestException, e:
+                self.printer.log_only("Part %s failed: %s" % (index + 1, e))
+                continue
+            if 200 <= response.status_code < 300:
+                with self.lock:
+                    self.state['done'].append(index)
+                    self.save_state()
+                self.printer.info("Uploaded part %s of %s" % (index + 1, self.state['parts']))
+                return
+            if response.status_code < 500:
+                break
+        raise UploadError("Uploading part %s failed" % (index + 1), response)
+
+    def finish(self):
+        """
+        Upload all parts the server does not have yet and commit the upload.
+        Returns the response of the commit call, the local state is removed if
+        the server accepted or finally rejected it.
+        """
+        missing = [index for index in range(self.state['parts']) if index not in self.state['done']]
+        if missing:
+            pool = ThreadPool(min(self.workers, len(missing)))
+            try:
+                pool.map(self.upload_part, missing)
+            finally:
+                pool.close()
+                pool.join()
+        url = self.get_absolute_url('%s%s/commit/' % (UPLOADS_PATH, self.state['id']))
+        response = self.session.post(url, data=self.state['fields'])
+        if 200 <= response.status_code < 300 or response.status_code in FINAL_STATUS:
+            self.discard()
+        return response
+
+    def upload(self, fileobj, fields, extra=None, source=None):
+        """
+        Upload the payload read from `fileobj` in parts and commit it with
+        `fields`. Returns the response of the commit call.
+
+        `extra` (anything JSON serializable) is stored with the state, so it
+        is still available if the upload has to be resumed. `source` is
+        stored for check_source.
+
+        Raises UploadError if a part could not be uploaded, the upload can then
+        be resumed later.
+        """
+        self.store_payload(fileobj)
+        self.start(fields, extra, source)
+        return self.finish()
+
+    def resume(self, state):
+        """
+        Resume the interrupted upload described by `state` (as returned by
+        load_state), asking the server which parts it already received.
+        Returns the response of the commit call.
+        """
+        self.state = state
+        self.printer.always("Resuming interrupted upload (%s of %s parts done)" % (len(state['done']), state['parts']))
+        url = self.get_absolute_url('%s%s/' % (UPLOADS_PATH, state['id']))
+        response = self.session.get(url)
+        if response.status_code == 200:
+            try:
+                state['done'] = json.loads(response.content).get('parts', [])
+            except (ValueError, AttributeError):
+                raise CommandError("Could not resume upload: invalid response from server")
+            self.save_state()
+        elif response.status_code == 404:
+            self.printer.warning("The server does not know the interrupted upload anymore, starting over")
+            self.start(state['fields'], state.get('extra'), state.get('source'))
+        return self.finish()
@@ -0,0 +1,144 @@
+# -*- coding: utf-8 -*-
+from __future__ import with_statement
+from contextlib import contextmanager
+from cookielib import DefaultCookiePolicy
+from requests.adapters import HTTPAdapter
+import requests
+import threading
+try:
+    from requests.packages.urllib3.util.retry import Retry
+except ImportError: # requests < 2.4 only retries failed connections
+    Retry = None
+
+DEFAULT_POOL_CONNECTIONS = 10
+DEFAULT_CONNECT_TIMEOUT = 10.0
+DEFAULT_READ_TIMEOUT = 60.0
+DEFAULT_RETRIES = 2
+DEFAULT_RETRY_BACKOFF = 0.5
+# methods retried after a failed read, the others may have a streamed body
+# which can't be sent again
+RETRY_METHODS = frozenset(['HEAD', 'GET', 'OPTIONS', 'TRACE'])
+# upper bounds of the latency histogram buckets in milliseconds
+LATENCY_BUCKETS = [10, 25, 50, 100, 250, 500, 1000, 2500, 5000]
+
+
+def make_session(pool_connections=DEFAULT_POOL_CONNECTIONS, max_connections=10,
+                 retries=DEFAULT_RETRIES, backoff=DEFAULT_RETRY_BACKOFF, keep_cookies=False):
+    """
+    Return a requests session keeping connections to at most
+    `pool_connections` hosts and opening at most `max_connections` connections
+    per host (further requests wait for a free connection).
+
+    Failed connections, and failed reads of requests in RETRY_METHODS, are
+    retried up to `retries` times, waiting `backoff` * 2 ** (retry - 1)
+    seconds in between.
+
+    Unless `keep_cookies` is set, the session does not keep cookies, so
+    they can be passed through from and to the browsers.
+    """
+    if Retry is not None:
+        try:
+            max_retries = Retry(total=retries, backoff_factor=backoff, allowed_methods=RETRY_METHODS)
+        except TypeError: # urllib3 < 1.26
+            max_retries = Retry(total=retries, backoff_factor=backoff, method_whitelist=RETRY_METHODS)
+    else:
+        max_retries = retries
+    adapter = HTTPAdapter(pool_connections=pool_connections, pool_maxsize=max_connections,
+                          max_retries=max_retries, pool_block=True)
+    session = requests.session()
+    if not keep_cookies:
+        session.cookies.set_policy(DefaultCookiePolicy(allowed_domains=[]))
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+def get_connection_stats(session):
+    """
+    Return a dictionary mapping the hosts `session` has connection pools for
+    to the number of connections opened (so TLS handshakes for https), the
+    number of requests made and how many of those reused a connection.
+    """
+    stats = {}
+    adapters = []
+    for adapter in session.adapters.values():
+        if adapter not in adapters:
+            adapters.append(adapter)
+    for adapter in adapters:
+        pools = adapter.poolmanager.pools
+        for key in pools.keys():
+            try:
+                pool = pools[key]
+            except KeyError:
+                # evicted in the meantime
+                continue
+            opened = getattr(pool, 'num_connections', 0)
+            made = getattr(pool, 'num_requests', 0)
+            stats['%s://%s:%s' % (pool.scheme, pool.host, pool.port)] = {
+                'opened': opened,
+                'requests': made,
+                'reused': max(0, made - opened),
+            }
+    return stats
+
+
+class UpstreamStats(object):
+    """
+    Thread safe counters for the requests made to the proxied site: the
+    number of requests, failed requests, requests in flight and a histogram
+    of the time until the response headers arrived.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.errors = 0
+        self.in_flight = 0
+        self.latencies = [0] * (len(LATENCY_BUCKETS) + 1)
+
+    @contextmanager
+    def track(self):
+        """
+        Count a request as in flight while the with block runs.
+        """
+        with self.lock:
+            self.in_flight += 1
+        try:
+            yield
+        finally:
+            with self.lock:
+                self.in_flight -= 1
+
+    def record(self, latency):
+        """
+        Record a request whose response headers arrived after `latency`
+        seconds, or which failed if `latency` is None.
+        """
+        with self.lock:
+            self.requests += 1
+            if latency is None:
+                self.errors += 1
+                return
+            milliseconds = latency * 1000
+            for index, bound in enumerate(LATENCY_BUCKETS):
+                if milliseconds <= bound:
+                    break
+            else:
+                index = len(LATENCY_BUCKETS)
+            self.latencies[index] += 1
+
+    def to_json(self):
+        """
+        Return the counters as a dictionary. The latency histogram has the
+        upper bounds of its buckets in milliseconds in 'buckets' and the
+        number of requests per bucket, plus the number of slower requests, in
+        'counts'.
+        """
+        with self.lock:
+            return {
+                'requests': self.requests,
+                'errors': self.errors,
+                'in_flight': self.in_flight,
+                'latency': {
+                    'buckets': LATENCY_BUCKETS,
+                    'counts': list(self.latencies),
+                },
+            }
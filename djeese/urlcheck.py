@@ -0,0 +1,211 @@
+# -*- coding: utf-8 -*-
+from __future__ import with_statement
+from djeese.httpcache import CacheEntry, ResponseCache, get_lifetime, is_storable
+from multiprocessing.pool import ThreadPool
+import os
+import requests
+import threading
+import time
+
+DEFAULT_TIMEOUT = 5
+DEFAULT_WORKERS = 8
+# seconds a successful check is remembered
+URL_CACHE_TTL = 5 * 60
+# largest remote template or license fetched, in bytes
+FETCH_MAX_SIZE = 10 * 1024 * 1024
+FETCH_CHUNKSIZE = 64 * 1024
+FETCH_CACHE_DIR = os.path.join(os.path.expanduser('~'), '.djeese-remote')
+# in memory part of the fetch cache, in MB
+FETCH_CACHE_SIZE = 16
+
+
+class URLChecker(object):
+    """
+    Thread safe checker for whether URLs can be loaded, checking up to
+    `workers` URLs at the same time.
+
+    URLs are checked with a HEAD request, falling back to a GET request if the
+    server does not answer HEAD requests successfully. Successful checks are
+    remembered for `ttl` seconds, failed ones are retried every time, since
+    they are usually fixed and checked again right away.
+    """
+    def __init__(self, workers=DEFAULT_WORKERS, ttl=URL_CACHE_TTL):
+        self.workers = workers
+        self.ttl = ttl
+        self.checked = {}
+        self.lock = threading.Lock()
+        self.session = requests.session()
+
+    def get_cached(self, url):
+        with self.lock:
+            checked = self.checked.get(url)
+        return checked is not None and time.time() - checked < self.ttl
+
+    def fetch(self, url, timeout):
+        """
+        Check `url` without looking at the cache.
+        """
+        try:
+            response = self.session.head(url, timeout=timeout, allow_redirects=True)
+            if 200 <= response.status_code < 300:
+                return True
+            # some servers don't implement HEAD (correctly)
+            response = self.session.get(url, timeout=timeout, stream=True)
+            response.close()
+            return 200 <= response.status_code < 300
+        except requests.RequestException:
+            return False
+
+    def mark_checked(self, url):
+        with self.lock:
+            self.checked[url] = time.time()
+
+    def check(self, url, timeout=DEFAULT_TIMEOUT):
+        """
+        Check whether `url` can be loaded.
+        """
+        if self.get_cached(url):
+            return True
+        success = self.fetch(url, timeout)
+        if success:
+            self.mark_checked(url)
+        return success
+
+    def check_many(self, urls, timeout=DEFAULT_TIMEOUT):
+        """
+        Check a list of URLs, each distinct URL only once. Returns a list of
+        (url, success) tuples in the order of `urls`.
+        """
+        unique = []
+        for url in urls:
+            if url not in unique:
+                unique.append(url)
+        if len(unique) > 1:
+            pool = ThreadPool(min(self.workers, len(unique)))
+            try:
+                results = pool.map(lambda url: self.check(url, timeout), unique)
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            results = [self.check(url, timeout) for url in unique]
+        results = dict(zip(unique, results))
+        return [(url, results[url]) for url in urls]
+
+
+class RemoteFetcher(object):
+    """
+    Downloads remote files (templates and licenses), up to `workers` at the
+    same time, through the session of `checker`.
+
+    Downloads are cached in `cache_dir` following the cache headers of the
+    responses, so unchanged files are not downloaded again by the next
+    upload.
+    """
+    def __init__(self, checker, workers=DEFAULT_WORKERS, cache_dir=FETCH_CACHE_DIR):
+        self.checker = checker
+        self.workers = workers
+        self.cache_dir = cache_dir
+        self.cache = None
+        self.lock = threading.Lock()
+
+    def get_cache(self):
+        # created lazily, since creating it prunes the cache directory
+        with self.lock:
+            if self.cache is None:
+                self.cache = ResponseCache(FETCH_CACHE_SIZE, self.cache_dir)
+            return self.cache
+
+    def fetch(self, url, timeout=DEFAULT_TIMEOUT, max_size=FETCH_MAX_SIZE):
+        """
+        Return the contents of `url`. Raises IOError if it can't be loaded
+        within `timeout` seconds (per connect and read) or is larger than
+        `max_size` bytes.
+        """
+        cache = self.get_cache()
+        key = cache.get_key(url, {})
+        entry = cache.get(key)
+        now = time.time()
+        if entry is not None and entry.is_fresh(now):
+            cache.count('hits')
+            return entry.body
+        headers = entry.get_validators() if entry is not None else {}
+        try:
+            response = self.checker.session.get(url, headers=headers, timeout=timeout, stream=True)
+            try:
+                if entry is not None and response.status_code == 304:
+                    cache.count('revalidated')
+                    entry.refresh(response.headers, now)
+                    cache.set(key, entry)
+                    return entry.body
+                if not 200 <= response.status_code < 300:
+                    raise IOError("Could not load %r (status %s)" % (url, response.status_code))
+                body = self.read(response, max_size)
+            finally:
+                response.close()
+        except requests.RequestException, e:
+            raise IOError("Could not load %r: %s" % (url, e))
+        cache.count('misses')
+        self.checker.mark_checked(url)
+        if is_storable(response.status_code, response.headers):
+            lifetime = get_lifetime(response.headers, now)
+            # the body is decoded, the header would be wrong
+            headers = dict([(name, value) for name, value in response.headers.items()
+                            if name.lower() != 'content-encoding'])
+            cache.set(key, CacheEntry(response.status_code, headers, body, now, lifetime))
+        return body
+
+    def read(self, response, max_size):
+        """
+        Read the body of `response`, raising IOError if it is larger than
+        `max_size` bytes.
+        """
+        message = "%r is larger than %s bytes" % (response.url, max_size)
+        try:
+            if int(response.headers.get('content-length', 0)) > max_size:
+                raise IOError(message)
+        except ValueError:
+            pass
+        chunks = []
+        size = 0
+        for chunk in response.iter_content(FETCH_CHUNKSIZE):
+            size += len(chunk)
+            if size > max_size:
+                raise IOError(message)
+            chunks.append(chunk)
+        return ''.join(chunks)
+
+    def fetch_many(self, urls, timeout=DEFAULT_TIMEOUT, max_size=FETCH_MAX_SIZE):
+        """
+        Fetch a list of URLs at the same time, each distinct URL only once.
+        Returns a dictionary mapping the URLs to their contents and raises
+        IOError if any of them can't be loaded.
+        """
+        unique = []
+        for url in urls:
+            if url not in unique:
+                unique.append(url)
+        if len(unique) > 1:
+            pool = ThreadPool(min(self.workers, len(unique)))
+            try:
+                contents = pool.map(lambda url: self.fetch(url, timeout, max_size), unique)
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            contents = [self.fetch(url, timeout, max_size) for url in unique]
+        return dict(zip(unique, contents))
+
+
+# shared by everything checking URLs, so each URL is only checked once
+checker = URLChecker()
+fetcher = RemoteFetcher(checker)
+
+def check_url(url, timeout=DEFAULT_TIMEOUT):
+    return checker.check(url, timeout)
+
+def check_urls(urls, timeout=DEFAULT_TIMEOUT):
+    return checker.check_many(urls, timeout)
+
+def fetch_urls(urls, timeout=DEFAULT_TIMEOUT, max_size=FETCH_MAX_SIZE):
+    return fetcher.fetch_many(urls, timeout, max_size)
@@ -2,13 +2,20 @@
 from __future__ import with_statement
 from StringIO import StringIO
 from collections import defaultdict
+from djeese.compression import (DEFAULT_COMPRESSION, DEFAULT_LEVEL,
+    DEFAULT_WORKERS, get_writer, is_precompressed, report_throughput)
+from djeese.sdist import SdistCache
+from djeese.urlcheck import fetch_urls
+from multiprocessing import TimeoutError
+from multiprocessing.pool import ThreadPool
 import os
 import re
 import requests
 import shutil
-import subprocess
+import socket
 import tarfile
 import tempfile
+import time
 import unicodedata
 import urlparse
 import xmlrpclib
@@ -16,16 +23,6 @@ try:
     import json
 except ImportError:
     import simplejson as json
-try:
-    from requests import async
-except RuntimeError:
-    class dummy_async(object):
-        def get(self, url, **kwargs):
-            return requests.get(url, **kwargs)
-        
-        def map(self, rs):
-            return rs
-    async = dummy_async()
 
 
 PYPI_KEYS = [
@@ -39,18 +36,13 @@ DJANGOPACKAGES_KEYS = [
     'repo_description',
 ]
 
-def check_urls(urls, timeout=5):
-    """
-    Checks a list of URLs (asynchronously if possible)
-    """
-    rs = [async.get(url, timeout=5) for url in urls]
-    return [(response.url, 200 <= response.status_code < 300) for response in async.map(rs)]
-
-def _check_url(url):
-    """
-    Checks a single URL
-    """
-    return requests.get(url, timeout=5).status_code == 200
+PYPI_JSON_URL = 'https://pypi.org/pypi/%s/json'
+# seconds the PyPI and djangopackages lookups may take together
+PACKAGE_DATA_TIMEOUT = 10
+PACKAGE_CACHE_DIR = os.path.join(os.path.expanduser('~'), '.djeese-packages')
+PACKAGE_CACHE_TTL = 24 * 60 * 60
+# bundles larger than this are spooled to a temporary file
+BUNDLE_SPOOL_SIZE = 8 * 1024 * 1024
 
 def slugify(value):
     """
@@ -68,12 +60,32 @@ def _transform_pypi(data):
     """
     Transform the data from PyPI into the data we want.
     """
-    return dict([(key, value) for key, value in data.items() if value != "UNKNOWN" and key in PYPI_KEYS])
+    return dict([(key, value) for key, value in data.items() if value not in ("UNKNOWN", "", None) and key in PYPI_KEYS])
 
-def get_pypi_data(slug):
+def get_pypi_data(slug, timeout=PACKAGE_DATA_TIMEOUT):
     """
     Download and process data on PyPI for an app with given slug, if available.
     If not available, returns empty dictionary.
+
+    Uses the JSON API, falling back to the slower XML-RPC API if that fails.
+    """
+    try:
+        response = requests.get(PYPI_JSON_URL % slug, timeout=timeout)
+    except requests.RequestException:
+        response = None
+    if response is not None:
+        if response.status_code == 404:
+            return {}
+        if response.status_code == 200:
+            try:
+                return _transform_pypi(json.loads(response.content)['info'])
+            except (ValueError, KeyError):
+                pass
+    return _get_pypi_xmlrpc_data(slug)
+
+def _get_pypi_xmlrpc_data(slug):
+    """
+    Download and process data on PyPI using the XML-RPC API.
     """
     client = xmlrpclib.ServerProxy('http://pypi.python.org/pypi')
     try:
@@ -105,60 +117,135 @@ def _transform_djangopackages(data):
     data = dict([(key, value) for key, value in data.items() if key in DJANGOPACKAGES_KEYS])
     data['description'] = data.pop('repo_description', None)
     data['url'] = url
-    data['author_url'] = _find_author_url(url)
+    data['author_url'] = _find_author_url(url) if url else None
     return data
 
-def get_djangopackages_data(slug):
+def get_djangopackages_data(slug, timeout=5):
     """
     Download and process data from djangopackages using their API.
     """
     url = 'http://djangopackages.com/api/v1/package/%s/' % slug
-    response = requests.get(url, timeout=5)
+    response = requests.get(url, timeout=timeout)
     if response.status_code != 200:
         return {'description': None}
     data = json.loads(response.content)
     return _transform_djangopackages(data)
 
-def get_package_data(slug):
+def _get_package_cache_path(slug):
+    return os.path.join(PACKAGE_CACHE_DIR, '%s.json' % slug)
+
+def _load_cached_package_data(slug, ttl):
+    """
+    Return the cached package data for `slug` if it is younger than `ttl`
+    seconds, otherwise None.
+    """
+    try:
+        with open(_get_package_cache_path(slug)) as fobj:
+            cached = json.load(fobj)
+    except (IOError, ValueError):
+        return None
+    if time.time() - cached.get('fetched', 0) > ttl:
+        return None
+    return cached.get('data')
+
+def _save_cached_package_data(slug, data):
+    if not os.path.exists(PACKAGE_CACHE_DIR):
+        os.makedirs(PACKAGE_CACHE_DIR)
+    path = _get_package_cache_path(slug)
+    tmppath = '%s.%s.tmp' % (path, os.getpid())
+    with open(tmppath, 'w') as fobj:
+        json.dump({'fetched': time.time(), 'data': data}, fobj)
+    os.rename(tmppath, path)
+
+def get_package_data(slug, timeout=PACKAGE_DATA_TIMEOUT, ttl=PACKAGE_CACHE_TTL):
     """
     Get package data from Djangopackages and PyPI
+
+    Both are asked at the same time and may take `timeout` seconds together,
+    sources which didn't answer in time are left out. Complete results are
+    cached in PACKAGE_CACHE_DIR for `ttl` seconds.
     """
     data = defaultdict(lambda:None)
-    data.update(get_pypi_data(slug))
-    data.update(get_djangopackages_data(slug))
+    cached = _load_cached_package_data(slug, ttl)
+    if cached is not None:
+        data.update(cached)
+        return data
+    deadline = time.time() + timeout
+    pool = ThreadPool(2)
+    try:
+        results = [
+            pool.apply_async(get_pypi_data, (slug, timeout)),
+            pool.apply_async(get_djangopackages_data, (slug, timeout)),
+        ]
+        complete = True
+        for result in results:
+            try:
+                data.update(result.get(max(0, deadline - time.time())))
+            except (TimeoutError, requests.RequestException, xmlrpclib.Error,
+                    socket.error, ValueError):
+                complete = False
+    finally:
+        # doesn't wait for threads still waiting for an answer, they are
+        # daemons and end with their request timeout
+        pool.terminate()
+    if complete:
+        try:
+            _save_cached_package_data(slug, dict(data))
+        except (IOError, OSError):
+            pass
     return data
 
-def _bundle(workspace, setuppy, config):
+def _add_file(tarball, writer, path, arcname):
     """
-    Does the actual bundling for `bundle`.
+    Add the file at `path` to `tarball` without compressing it again if it is
+    already compressed.
     """
-    fnull = open(os.devnull, 'w')
+    if is_precompressed(path):
+        writer.set_level(0)
     try:
-        subprocess.check_call(['python', setuppy, 'sdist', '-d', workspace], stdout=fnull, stderr=fnull)
+        tarball.add(path, arcname=arcname)
     finally:
-        fnull.close()
-    eggfile = os.path.join(workspace, os.listdir(workspace)[0])
-    bundle = StringIO()
-    tarball = tarfile.open(fileobj=bundle, mode='w:gz')
+        writer.set_level()
+
+def _add_data(tarball, data, arcname):
+    """
+    Add the string `data` to `tarball` as a file named `arcname`.
+    """
+    info = tarfile.TarInfo(arcname)
+    info.size = len(data)
+    info.mtime = time.time()
+    tarball.addfile(info, StringIO(data))
+
+def _bundle(workspace, setuppy, config, compression, level, workers, printer):
+    """
+    Does the actual bundling for `bundle`.
+    """
+    templates = config['templates'].as_dict()
+    remote = [fpath for fpath in templates.values() if fpath.startswith(('http://', 'https://'))]
+    if 'license-path' not in config['app']:
+        remote.append(config['app']['license-text'])
+    # fetch everything up front and at once, instead of one by one while packing
+    contents = fetch_urls(remote)
+    eggfile = SdistCache().build(setuppy, workspace)
+    bundle = tempfile.SpooledTemporaryFile(BUNDLE_SPOOL_SIZE)
+    writer = get_writer(bundle, compression, level, workers)
+    tarball = tarfile.open(fileobj=writer, mode='w')
     # add the egg
-    tarball.add(eggfile, arcname='package.tar.gz')
+    _add_file(tarball, writer, eggfile, 'package.tar.gz')
     # add templates
-    templates = config['templates'].as_dict()
     for arcname, fpath in templates.items():
         full_arcname = 'templates/%s' % arcname
         # backwards compatibility, check for URL:
-        if fpath.startswith(('http://', 'https://')):
-            response = requests.get(fpath)
-            tarball.addfile(tarfile.TarInfo(full_arcname), response)
+        if fpath in contents:
+            _add_data(tarball, contents[fpath], full_arcname)
         else:
-            tarball.add(fpath, arcname=full_arcname)
+            _add_file(tarball, writer, fpath, full_arcname)
     # add license
     # backwards compatibility, check for old license-text option:
     if 'license-path' in config['app']:
-        tarball.add(config['app']['license-path'], arcname='meta/LICENSE.txt')
+        _add_file(tarball, writer, config['app']['license-path'], 'meta/LICENSE.txt')
     else:
-        response = requests.get(config['app']['license-text'])
-        tarball.addfile(tarfile.TarInfo('meta/LICENSE.txt'), response)
+        _add_data(tarball, contents[config['app']['license-text']], 'meta/LICENSE.txt')
     # add the config
     configpath = os.path.join(workspace, 'config')
     with open(configpath, 'w') as fobj:
@@ -166,16 +253,23 @@ def _bundle(workspace, setuppy, config):
     tarball.add(configpath, 'meta/config.cfg')
     # close, seek, return
     tarball.close()
+    writer.close()
+    if printer is not None:
+        report_throughput(writer, printer)
     bundle.seek(0)
     return bundle
 
-def bundle_app(setuppy, config):
+def bundle_app(setuppy, config, compression=DEFAULT_COMPRESSION, level=DEFAULT_LEVEL,
+               workers=DEFAULT_WORKERS, printer=None):
     """
     Bundles a setup.py and all other files required (templates/license) into
-    a StringIO bundle (gzipped)
+    a file like bundle, which is kept in memory up to BUNDLE_SPOOL_SIZE
+    bytes and spooled to a temporary file above that, compressed according to `compression` (see
+    djeese.compression.get_writer). If a printer is given, the compression
+    throughput is reported to it.
     """
     distdir = tempfile.mkdtemp(prefix='djeese')
     try:
-        return _bundle(distdir, setuppy, config)
+        return _bundle(distdir, setuppy, config, compression, level, workers, printer)
     finally:
         shutil.rmtree(distdir)